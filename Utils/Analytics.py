@@ -0,0 +1,214 @@
+import json
+import os
+import threading
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401  - only needed for the optional Parquet snapshot
+except ImportError:
+    pyarrow = None
+
+from Utils import Partitions, Storage
+from Utils.Profiling import timed
+from Utils.Storage import data_version, file_signature
+
+# Columnar copies of the patient files: one row per visit, and tests flattened
+# into their own frame keyed by visit id. Frames are cached per partition file and
+# only the new rows are converted when the visits since the last build were pure appends.
+VISIT_FIELDS = ["id", "date", "time", "name", "age", "gender", "phone", "consultation_fee", "total_amount"]
+TEST_FIELDS = ["visit_id", "date", "name", "value", "cost"]
+
+# Suffixes added to the data file's path, e.g. Data/patients/2026-10.json.visits.parquet
+SNAPSHOT_VISITS = ".visits.parquet"
+SNAPSHOT_TESTS = ".tests.parquet"
+SNAPSHOT_META = ".snapshot.json"
+
+AGE_BINS = [0, 13, 20, 40, 60, 200]
+AGE_LABELS = ["0-12", "13-19", "20-39", "40-59", "60+"]
+
+_frames = {}
+_frames_lock = threading.Lock()
+
+
+def _drop_frames(data):
+    # Frames of a list the storage cache has evicted would keep it alive
+    with _frames_lock:
+        for filepath, cached in list(_frames.items()):
+            if cached["data"] is data:
+                del _frames[filepath]
+
+
+Storage.on_evict(_drop_frames)
+
+
+def _columns(patients):
+    visits = {field: [] for field in VISIT_FIELDS}
+    tests = {field: [] for field in TEST_FIELDS}
+    for p in patients:
+        for field in VISIT_FIELDS:
+            visits[field].append(p.get(field))
+        for test in p.get("tests", []):
+            tests["visit_id"].append(p.get("id"))
+            tests["date"].append(p.get("date"))
+            tests["name"].append(test.get("name"))
+            tests["value"].append(test.get("value"))
+            tests["cost"].append(test.get("cost"))
+    return visits, tests
+
+
+def _to_frames(visit_columns, test_columns):
+    visits = pd.DataFrame(visit_columns, columns=VISIT_FIELDS)
+    visits["date"] = pd.to_datetime(visits["date"], format="%Y-%m-%d", errors="coerce")
+    for field in ("age", "consultation_fee", "total_amount"):
+        visits[field] = pd.to_numeric(visits[field], errors="coerce")
+
+    tests = pd.DataFrame(test_columns, columns=TEST_FIELDS)
+    tests["date"] = pd.to_datetime(tests["date"], format="%Y-%m-%d", errors="coerce")
+    tests["cost"] = pd.to_numeric(tests["cost"], errors="coerce")
+    tests["name"] = tests["name"].astype("category")
+    return visits, tests
+
+
+def _snapshot_paths(filepath):
+    return filepath + SNAPSHOT_VISITS, filepath + SNAPSHOT_TESTS, filepath + SNAPSHOT_META
+
+
+def _signature_key(filepath):
+    return json.loads(json.dumps(file_signature(filepath)))
+
+
+def save_snapshot(filepath, visits, tests, signature=None):
+    # Parquet copy of the frames, tagged with the data file's signature at the time
+    # they were built; the tag is written last, so a half-written snapshot is never used
+    if pyarrow is None:
+        return False
+    visits_path, tests_path, meta_path = _snapshot_paths(filepath)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    visits.to_parquet(visits_path, index=False)
+    tests.to_parquet(tests_path, index=False)
+    with open(meta_path, "w") as f:
+        json.dump({"signature": signature or _signature_key(filepath), "rows": len(visits)}, f)
+    return True
+
+
+def _save_snapshot_later(filepath, visits, tests, signature):
+    if pyarrow is None:
+        return
+    threading.Thread(target=save_snapshot, args=(filepath, visits, tests, signature),
+                     name="analytics-snapshot", daemon=True).start()
+
+
+def load_snapshot(filepath):
+    # Returns (visits, tests) if the snapshot still matches the data file on disk
+    if pyarrow is None:
+        return None
+    visits_path, tests_path, meta_path = _snapshot_paths(filepath)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get("signature") != _signature_key(filepath):
+        return None
+    return pd.read_parquet(visits_path), pd.read_parquet(tests_path)
+
+
+def _store(filepath, patients, version, signature, visits, tests):
+    _frames[filepath] = {"data": patients, "version": version, "signature": signature,
+                         "rows": len(visits), "visits": visits, "tests": tests}
+    return visits, tests
+
+
+@timed()
+def visit_frames(filepath, patients=None):
+    # Frames still matching the file on disk (or its Parquet snapshot) are returned
+    # without parsing the JSON; patients is only loaded when they have to be built.
+    # The signature is taken first, so frames are never tagged newer than their data.
+    signature = _signature_key(filepath)
+    with _frames_lock:
+        cached = _frames.get(filepath)
+        if cached is not None and cached["signature"] == signature:
+            return cached["visits"], cached["tests"]
+
+    if cached is None and patients is None:
+        snapshot = load_snapshot(filepath)
+        if snapshot is not None:
+            with _frames_lock:
+                return _store(filepath, None, None, signature, *snapshot)
+
+    if patients is None:
+        # Outside _frames_lock: loading can evict other files, which calls back into _drop_frames
+        patients = Partitions.load_partition(filepath)
+    with _frames_lock:
+        version = data_version(filepath)
+        cached = _frames.get(filepath)
+        if cached is not None and cached["data"] is patients:
+            writes = version[0] - cached["version"][0]
+            appends = version[1] - cached["version"][1]
+            if writes == 0:
+                return _store(filepath, patients, version, signature, cached["visits"], cached["tests"])
+            if writes == appends and len(patients) == cached["rows"] + appends:
+                new_visits, new_tests = _to_frames(*_columns(patients[cached["rows"]:]))
+                visits = pd.concat([cached["visits"], new_visits], ignore_index=True)
+                tests = pd.concat([cached["tests"], new_tests], ignore_index=True)
+                tests["name"] = tests["name"].astype("category")
+                return _store(filepath, patients, version, signature, visits, tests)
+
+        visits, tests = _to_frames(*_columns(patients))
+        _store(filepath, patients, version, signature, visits, tests)
+    if cached is None:
+        # Only cold builds are snapshotted, and off the request path
+        _save_snapshot_later(filepath, visits, tests, signature)
+    return visits, tests
+
+
+def range_frames(data_dir, start, end):
+    # Frames for the partitions a date range reaches, trimmed to the range
+    frames = [visit_frames(filepath) for filepath in Partitions.partition_files(data_dir, start, end)]
+    if not frames:
+        return _to_frames(*_columns([]))
+    visits = pd.concat([v for v, _ in frames], ignore_index=True)
+    tests = pd.concat([t for _, t in frames], ignore_index=True)
+    tests["name"] = tests["name"].astype("category")
+    return between(visits, tests, start, end)
+
+
+def between(visits, tests, start, end):
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    return (visits[(visits["date"] >= start) & (visits["date"] <= end)],
+            tests[(tests["date"] >= start) & (tests["date"] <= end)])
+
+
+def revenue_per_test(tests):
+    grouped = tests.groupby("name", observed=True)["cost"].agg(revenue="sum", tests="count")
+    return grouped.sort_values("revenue", ascending=False)
+
+
+def visits_per_day(visits):
+    return visits.groupby("date").agg(visits=("id", "size"), revenue=("total_amount", "sum"))
+
+
+def visits_per_week(visits):
+    return (visits.dropna(subset=["date"]).set_index("date")
+            .resample("W")
+            .agg({"id": "size", "total_amount": "sum"})
+            .rename(columns={"id": "visits", "total_amount": "revenue"}))
+
+
+def age_gender_breakdown(visits):
+    age_group = pd.cut(visits["age"], AGE_BINS, labels=AGE_LABELS, right=False)
+    return pd.crosstab(age_group, visits["gender"].fillna("Not specified"))
+
+
+def averages(visits, tests):
+    count = len(visits)
+    if not count:
+        return {"visits": 0, "avg_total": 0, "avg_consultation": 0, "avg_test_revenue": 0, "avg_tests": 0}
+    return {
+        "visits": count,
+        "avg_total": float(visits["total_amount"].mean()),
+        "avg_consultation": float(visits["consultation_fee"].mean()),
+        "avg_test_revenue": float(tests["cost"].sum()) / count,
+        "avg_tests": len(tests) / count,
+    }
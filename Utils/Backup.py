@@ -0,0 +1,303 @@
+import datetime
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import sys
+import xml.etree.ElementTree as ET
+from collections import Counter
+from contextlib import contextmanager
+
+from Utils import Partitions
+from Utils.Export import open_xml, patient_to_xml, write_patients_xml, PROGRESS_EVERY, XML_HEADER
+from Utils.Profiling import timed
+from Utils.Storage import load_json, save_json
+
+# A backup chain is one full "base" file followed by deltas holding only the
+# records added or removed since the previous backup. Records are identified by
+# the hash of their compact XML form, so an edit shows up as delete + add.
+MANIFEST_FILE = "backup_manifest.json"
+INDEX_FILE = "backup_index.json"
+FULL_EVERY = 7
+
+# Retention defaults, overridable from admin_config.json
+KEEP_DAYS = 30
+KEEP_MIN = 5
+
+
+def record_hash(patient):
+    return hashlib.sha1(patient_to_xml(patient, indent=None).encode("utf-8")).hexdigest()
+
+
+def _manifest_path(backup_dir):
+    return os.path.join(backup_dir, MANIFEST_FILE)
+
+
+def load_manifest(backup_dir):
+    if not os.path.exists(_manifest_path(backup_dir)):
+        return None
+    return load_json(_manifest_path(backup_dir), {}) or None
+
+
+def _element_text(elem):
+    return elem.text if elem.text is not None else ""
+
+
+def _read_patient(elem):
+    record = {}
+    for child in elem:
+        if child.tag == "Tests":
+            record["tests"] = [{field.tag: _element_text(field) for field in test} for test in child]
+        else:
+            record[child.tag] = _element_text(child)
+    return record
+
+
+def iter_backup(path):
+    # Yields ("deleted", hash) and ("patient", record) in file order, as raw text
+    with open_xml(path, "rb") as f:
+        for _, elem in ET.iterparse(f):
+            if elem.tag == "Hash":
+                for _ in range(int(elem.get("count", 1))):
+                    yield "deleted", elem.text
+            elif elem.tag == "Patient":
+                yield "patient", _read_patient(elem)
+                elem.clear()
+
+
+def _as_number(text):
+    try:
+        number = int(text)
+    except (TypeError, ValueError):
+        return text
+    return number if str(number) == text else text
+
+
+def restore_types(record):
+    restored = {key: (_as_number(value) if key in ("age", "consultation_fee", "total_amount") else value)
+                for key, value in record.items()}
+    if "tests" in record:
+        restored["tests"] = [dict(test, cost=_as_number(test["cost"])) if "cost" in test else test
+                             for test in record["tests"]]
+    return restored
+
+
+def _stamp():
+    return datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S_%f")
+
+
+def _new_file(backup_dir, prefix, suffix):
+    # Claims a file name no other backup has (created with "x"), even for two
+    # backups started in the same instant; returns the name
+    stamp = _stamp()
+    attempt = 0
+    while True:
+        filename = f"{prefix}{stamp}{f'_{attempt}' if attempt else ''}.xml{suffix}"
+        try:
+            open(os.path.join(backup_dir, filename), "x").close()
+            return filename
+        except FileExistsError:
+            attempt += 1
+
+
+@contextmanager
+def _writing(backup_dir, filename, compress):
+    # The file is written under a temp name and renamed over the claimed one once
+    # complete, so a failure part way never leaves a truncated backup behind
+    path = os.path.join(backup_dir, filename)
+    tmp_path = path + ".tmp"
+    try:
+        with open_xml(tmp_path, "w", compress) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        for leftover in (tmp_path, path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+
+
+def _reporter(progress, offset, total):
+    if progress is None:
+        return None
+    return lambda done: progress(offset + done, total)
+
+
+def _hash_all(patients, progress=None):
+    hashes = Counter()
+    for done, patient in enumerate(patients, 1):
+        hashes[record_hash(patient)] += 1
+        if progress and done % PROGRESS_EVERY == 0:
+            progress(done)
+    return hashes
+
+
+@timed()
+def run_backup(patients, backup_dir, full=False, compress=False, progress=None):
+    # Returns the name of the file written, or None when nothing changed since the last backup.
+    # progress(done, total) is called as records are hashed and then written.
+    total = 2 * len(patients)
+    manifest = load_manifest(backup_dir)
+    hashes = _hash_all(patients, _reporter(progress, 0, total))
+    suffix = ".gz" if compress else ""
+
+    if full or manifest is None or len(manifest["deltas"]) >= manifest.get("full_every", FULL_EVERY):
+        # A new base never reuses the current one's name, so the live chain stays intact until
+        # the manifest points at the finished file
+        filename = _new_file(backup_dir, "patients_backup_", suffix)
+        with _writing(backup_dir, filename, compress) as f:
+            write_patients_xml(patients, f, progress=_reporter(progress, len(patients), total))
+        manifest = {"base": filename, "deltas": [], "hashes": dict(hashes), "full_every": FULL_EVERY}
+        save_json(_manifest_path(backup_dir), manifest)
+        return filename
+
+    previous = Counter(manifest["hashes"])
+    deleted = previous - hashes
+    pending = hashes - previous
+    if not deleted and not pending:
+        return None
+
+    filename = _new_file(backup_dir, "patients_delta_", suffix)
+    with _writing(backup_dir, filename, compress) as f:
+        f.write(XML_HEADER)
+        f.write(f'<PatientsDelta base="{manifest["base"]}">\n')
+        if deleted:
+            f.write("  <Deleted>\n")
+            for digest, count in deleted.items():
+                f.write(f'    <Hash count="{count}">{digest}</Hash>\n')
+            f.write("  </Deleted>\n")
+        written_report = _reporter(progress, len(patients), total)
+        for done, patient in enumerate(patients, 1):
+            digest = record_hash(patient)
+            if pending[digest] > 0:
+                pending[digest] -= 1
+                f.write(patient_to_xml(patient))
+            if written_report and done % PROGRESS_EVERY == 0:
+                written_report(done)
+        f.write("</PatientsDelta>\n")
+
+    manifest["deltas"].append(filename)
+    manifest["hashes"] = dict(hashes)
+    save_json(_manifest_path(backup_dir), manifest)
+    return filename
+
+
+def restore(backup_dir, manifest=None):
+    # Replays the base file and every delta after it, returning the patient list
+    manifest = manifest or load_manifest(backup_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"no {MANIFEST_FILE} in {backup_dir}")
+
+    records = [record for kind, record in iter_backup(os.path.join(backup_dir, manifest["base"])) if kind == "patient"]
+    for filename in manifest["deltas"]:
+        deleted = Counter()
+        added = []
+        for kind, item in iter_backup(os.path.join(backup_dir, filename)):
+            if kind == "deleted":
+                deleted[item] += 1
+            else:
+                added.append(item)
+
+        kept = []
+        for record in records:
+            digest = record_hash(record)
+            if deleted[digest] > 0:
+                deleted[digest] -= 1
+            else:
+                kept.append(record)
+        records = kept + added
+    return [restore_types(record) for record in records]
+
+
+def is_backup_file(filename):
+    return filename.endswith(".xml") or filename.endswith(".xml.gz")
+
+
+def count_records(path):
+    # Counts <Patient> tags chunk by chunk without parsing the file
+    tag = b"<Patient>"
+    count = 0
+    tail = b""
+    with open_xml(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            data = tail + chunk
+            count += data.count(tag)
+            tail = data[-(len(tag) - 1):]
+    return count
+
+
+def list_backups(backup_dir):
+    # Size, record count and date per backup file; record counts are cached in INDEX_FILE
+    index_path = os.path.join(backup_dir, INDEX_FILE)
+    index = load_json(index_path, {}) if os.path.exists(index_path) else {}
+    fresh = {}
+    backups = []
+    for filename in sorted(os.listdir(backup_dir), reverse=True):
+        if not is_backup_file(filename):
+            continue
+        st = os.stat(os.path.join(backup_dir, filename))
+        cached = index.get(filename)
+        if cached and cached["mtime_ns"] == st.st_mtime_ns and cached["size"] == st.st_size:
+            records = cached["records"]
+        else:
+            records = count_records(os.path.join(backup_dir, filename))
+        fresh[filename] = {"mtime_ns": st.st_mtime_ns, "size": st.st_size, "records": records}
+        backups.append({
+            "file": filename,
+            "kind": "delta" if filename.startswith("patients_delta_") else "full",
+            "size_kb": round(st.st_size / 1024, 1),
+            "records": records,
+            "modified": datetime.datetime.fromtimestamp(st.st_mtime).strftime("%Y-%m-%d %H:%M"),
+        })
+    if fresh != index:
+        save_json(index_path, fresh)
+    return backups
+
+
+def prune_backups(backup_dir, keep_days=KEEP_DAYS, keep_min=KEEP_MIN):
+    # Removes backups older than keep_days, always keeping the newest keep_min
+    # files and every file the current chain still needs for a restore
+    manifest = load_manifest(backup_dir) or {}
+    protected = {manifest.get("base")} | set(manifest.get("deltas", []))
+    cutoff = datetime.datetime.now().timestamp() - keep_days * 86400
+    files = [f for f in os.listdir(backup_dir) if is_backup_file(f)]
+    files.sort(key=lambda f: os.path.getmtime(os.path.join(backup_dir, f)), reverse=True)
+
+    removed = []
+    for filename in files[keep_min:]:
+        path = os.path.join(backup_dir, filename)
+        if filename not in protected and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed.append(filename)
+    return removed
+
+
+def read_for_download(backup_dir, filename, compress=False):
+    # Only called once the user asks for a file; gzips plain XML on the way out if requested
+    path = os.path.join(backup_dir, os.path.basename(filename))
+    if compress and not filename.endswith(".gz"):
+        buffer = io.BytesIO()
+        with open(path, "rb") as src, gzip.GzipFile(fileobj=buffer, mode="wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        return buffer.getvalue(), filename + ".gz"
+    with open(path, "rb") as f:
+        return f.read(), filename
+
+
+if __name__ == "__main__":
+    # python -m Utils.Backup backup <data_dir> <backup_dir> [--full] [--gzip]
+    # python -m Utils.Backup restore <backup_dir> <output.json>
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) == 3 and args[0] == "backup":
+        written = run_backup(Partitions.load_all(args[1]), args[2],
+                             full="--full" in sys.argv, compress="--gzip" in sys.argv)
+        print(f"Wrote {written}" if written else "No changes since the last backup")
+    elif len(args) == 3 and args[0] == "restore":
+        restored = restore(args[1])
+        save_json(args[2], restored)
+        print(f"Restored {len(restored)} record(s) into {args[2]}")
+    else:
+        print("usage: python -m Utils.Backup backup <data_dir> <backup_dir> [--full] [--gzip]\n"
+              "       python -m Utils.Backup restore <backup_dir> <output.json>")
+        sys.exit(1)
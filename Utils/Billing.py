@@ -0,0 +1,180 @@
+import bisect
+import os
+import sys
+
+from Utils import Partitions
+from Utils.Storage import save_json, set_value, pop_value, write_batch
+
+# Earnings rollups live in one flat map so every bucket can be journaled on its own:
+#   "d:2025-06-24" -> day, "m:2025-06" -> month, "y:2025" -> year
+# Each bucket is {"total", "consultation", "tests", "visits", "by_test": {name: amount}}.
+ROLLUP_FILE = "earnings_rollup.json"
+
+# rollup file -> (rollup object, sorted day keys, running totals)
+_prefix = {}
+
+
+def _bucket_keys(date):
+    return [f"d:{date}", f"m:{date[:7]}", f"y:{date[:4]}"]
+
+
+def _empty_bucket():
+    return {"total": 0, "consultation": 0, "tests": 0, "visits": 0, "by_test": {}}
+
+
+def _add_into(bucket, patient, sign):
+    bucket["total"] += sign * patient.get("total_amount", 0)
+    bucket["consultation"] += sign * patient.get("consultation_fee", 0)
+    bucket["visits"] += sign
+    for test in patient.get("tests", []):
+        bucket["tests"] += sign * test.get("cost", 0)
+        amount = bucket["by_test"].get(test["name"], 0) + sign * test.get("cost", 0)
+        if amount:
+            bucket["by_test"][test["name"]] = amount
+        else:
+            bucket["by_test"].pop(test["name"], None)
+
+
+def _merge(into, bucket):
+    for field in ("total", "consultation", "tests", "visits"):
+        into[field] += bucket[field]
+    for name, amount in bucket["by_test"].items():
+        into["by_test"][name] = into["by_test"].get(name, 0) + amount
+
+
+def _adjusted(bucket, patient, sign):
+    bucket = _empty_bucket() if bucket is None else dict(bucket, by_test=dict(bucket["by_test"]))
+    _add_into(bucket, patient, sign)
+    return bucket if bucket["visits"] > 0 else None
+
+
+def _record(rollup_file, rollup, changes):
+    # changes is [(patient, sign)]. The buckets are re-read under the storage lock, so terminals
+    # updating the same day don't clobber each other, and the day, month and year buckets of
+    # every change go into one journal entry, so they can't disagree after a crash.
+    def make_entries():
+        updated = {}
+        for patient, sign in changes:
+            for key in _bucket_keys(patient["date"]):
+                updated[key] = _adjusted(updated[key] if key in updated else rollup.get(key), patient, sign)
+        return [{"op": "set", "key": key, "value": bucket} if bucket is not None else {"op": "pop", "key": key}
+                for key, bucket in updated.items() if bucket is not None or key in rollup]
+
+    write_batch(rollup_file, rollup, make_entries)
+    _prefix.pop(rollup_file, None)
+
+
+def add_visit(rollup_file, rollup, patient):
+    _record(rollup_file, rollup, [(patient, 1)])
+
+
+def remove_visit(rollup_file, rollup, patient):
+    _record(rollup_file, rollup, [(patient, -1)])
+
+
+def edit_visit(rollup_file, rollup, old, new):
+    _record(rollup_file, rollup, [(old, -1), (new, 1)])
+
+
+def record_visits(rollup_file, rollup, changes):
+    # changes is [(old, new)] with old None for an added visit and new None for a removed one;
+    # all of them go into one journal entry
+    signed = []
+    for old, new in changes:
+        if old is not None:
+            signed.append((old, -1))
+        if new is not None:
+            signed.append((new, 1))
+    if signed:
+        _record(rollup_file, rollup, signed)
+
+
+def sync_daily(earnings_file, earnings, rollup, date):
+    # Keeps the flat date -> amount map in earnings.json in step with the rollup
+    bucket = rollup.get(f"d:{date}")
+    if bucket:
+        set_value(earnings_file, earnings, date, bucket["total"])
+    elif date in earnings:
+        pop_value(earnings_file, earnings, date)
+
+
+def sync_days(earnings_file, earnings, rollup, dates):
+    # sync_daily for several days in one journal entry
+    def make_entries():
+        entries = []
+        for date in sorted(set(dates)):
+            bucket = rollup.get(f"d:{date}")
+            if bucket:
+                entries.append({"op": "set", "key": date, "value": bucket["total"]})
+            elif date in earnings:
+                entries.append({"op": "pop", "key": date})
+        return entries
+
+    write_batch(earnings_file, earnings, make_entries)
+
+
+def day(rollup, date):
+    return rollup.get(f"d:{date}") or _empty_bucket()
+
+
+def month(rollup, year_month):
+    return rollup.get(f"m:{year_month}") or _empty_bucket()
+
+
+def year(rollup, year_str):
+    return rollup.get(f"y:{year_str}") or _empty_bucket()
+
+
+def _prefix_sums(rollup_file, rollup):
+    cached = _prefix.get(rollup_file)
+    if cached is not None and cached[0] is rollup:
+        return cached[1], cached[2]
+
+    days = sorted(key[2:] for key in rollup if key.startswith("d:"))
+    sums = [0]
+    for date in days:
+        sums.append(sums[-1] + rollup[f"d:{date}"]["total"])
+    _prefix[rollup_file] = (rollup, days, sums)
+    return days, sums
+
+
+def total_between(rollup_file, rollup, start, end):
+    days, sums = _prefix_sums(rollup_file, rollup)
+    lo = bisect.bisect_left(days, str(start))
+    hi = bisect.bisect_right(days, str(end))
+    return sums[hi] - sums[lo] if hi > lo else 0
+
+
+def breakdown_between(rollup_file, rollup, start, end):
+    days, _ = _prefix_sums(rollup_file, rollup)
+    result = _empty_bucket()
+    for date in days[bisect.bisect_left(days, str(start)):bisect.bisect_right(days, str(end))]:
+        _merge(result, rollup[f"d:{date}"])
+    return result
+
+
+def rebuild(patients):
+    rollup = {}
+    for patient in patients:
+        if not patient.get("date"):
+            continue
+        for key in _bucket_keys(patient["date"]):
+            _add_into(rollup.setdefault(key, _empty_bucket()), patient, 1)
+    return rollup
+
+
+def rebuild_files(data_dir):
+    rollup = rebuild(Partitions.iter_records(data_dir))
+    earnings = {key[2:]: bucket["total"] for key, bucket in sorted(rollup.items()) if key.startswith("d:")}
+    save_json(os.path.join(data_dir, ROLLUP_FILE), rollup)
+    save_json(os.path.join(data_dir, "earnings.json"), earnings)
+    return rollup
+
+
+if __name__ == "__main__":
+    # python -m Utils.Billing rebuild <data_dir>
+    if len(sys.argv) != 3 or sys.argv[1] != "rebuild":
+        print("usage: python -m Utils.Billing rebuild <data_dir>")
+        sys.exit(1)
+    rebuilt = rebuild_files(sys.argv[2])
+    print(f"Rebuilt {sum(1 for key in rebuilt if key.startswith('d:'))} day(s) of earnings")
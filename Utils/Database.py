@@ -0,0 +1,287 @@
+import json
+import os
+import sqlite3
+import sys
+from contextlib import contextmanager
+
+# Which JSON file each table stands in for
+TABLES = {
+    "patients.json": "visits",
+    "earnings.json": "earnings",
+    "tests.json": "test_catalog",
+}
+
+VISIT_COLUMNS = ["name", "age", "gender", "phone", "symptoms", "consultation_fee", "total_amount", "date", "time"]
+TEST_COLUMNS = ["name", "value", "cost"]
+
+# Every write to a table bumps its row in table_versions in the same transaction, so a
+# session can tell whether the copy it loaded is still the current one.
+# "seq" is the record's position in the patients list and "uid" its "id" field,
+# so the add / edit / delete entries used by Utils.Storage map straight onto rows.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS visits (
+    id INTEGER PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    uid TEXT,
+    name TEXT,
+    name_norm TEXT,
+    age INTEGER,
+    gender TEXT,
+    phone TEXT,
+    symptoms TEXT,
+    consultation_fee INTEGER,
+    total_amount INTEGER,
+    date TEXT,
+    time TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_visits_seq ON visits(seq);
+CREATE INDEX IF NOT EXISTS idx_visits_date ON visits(date);
+CREATE INDEX IF NOT EXISTS idx_visits_phone ON visits(phone);
+CREATE INDEX IF NOT EXISTS idx_visits_name_norm ON visits(name_norm);
+
+CREATE TABLE IF NOT EXISTS visit_tests (
+    visit_id INTEGER NOT NULL REFERENCES visits(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    name TEXT,
+    value TEXT,
+    cost INTEGER,
+    extra TEXT,
+    PRIMARY KEY (visit_id, position)
+);
+CREATE INDEX IF NOT EXISTS idx_visit_tests_name ON visit_tests(name);
+
+CREATE TABLE IF NOT EXISTS earnings (
+    date TEXT PRIMARY KEY,
+    amount INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS test_catalog (
+    name TEXT PRIMARY KEY,
+    cost INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS table_versions (
+    name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+KEY_COLUMNS = {"earnings": ("date", "amount"), "test_catalog": ("name", "cost")}
+
+
+def normalize_name(name):
+    return " ".join(str(name).lower().split())
+
+
+@contextmanager
+def connect(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.executescript(SCHEMA)
+        if "uid" not in [row[1] for row in conn.execute("PRAGMA table_info(visits)")]:
+            conn.execute("ALTER TABLE visits ADD COLUMN uid TEXT")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_visits_uid ON visits(uid)")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+@contextmanager
+def reading(db_path):
+    # One read transaction: every query inside sees the same state of the database
+    with connect(db_path) as conn:
+        conn.execute("BEGIN")
+        yield conn
+
+
+@contextmanager
+def writing(db_path):
+    # One write transaction; other sessions wait for it to commit before writing
+    with connect(db_path) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        yield conn
+
+
+def version(conn, table):
+    row = conn.execute("SELECT version FROM table_versions WHERE name = ?", (table,)).fetchone()
+    return row[0] if row else 0
+
+
+def _bump_version(conn, table):
+    conn.execute("INSERT INTO table_versions (name, version) VALUES (?, 1) "
+                 "ON CONFLICT(name) DO UPDATE SET version = version + 1", (table,))
+
+
+def _split(record, columns):
+    values = [record.get(col) for col in columns]
+    extra = {k: v for k, v in record.items() if k not in columns and k not in ("tests", "id")}
+    return values, (json.dumps(extra) if extra else None)
+
+
+def _join(columns, values, extra, uid=None):
+    record = {"id": uid} if uid is not None else {}
+    record.update((col, value) for col, value in zip(columns, values) if value is not None)
+    if extra:
+        record.update(json.loads(extra))
+    return record
+
+
+def _insert_visit(conn, seq, record):
+    values, extra = _split(record, VISIT_COLUMNS)
+    cur = conn.execute(
+        f"INSERT INTO visits (seq, uid, name_norm, {', '.join(VISIT_COLUMNS)}, extra) "
+        f"VALUES (?, ?, ?, {', '.join('?' * len(VISIT_COLUMNS))}, ?)",
+        [seq, record.get("id"), normalize_name(record.get("name", ""))] + values + [extra],
+    )
+    _insert_tests(conn, cur.lastrowid, record.get("tests", []))
+
+
+def _insert_tests(conn, visit_id, tests):
+    rows = []
+    for position, test in enumerate(tests):
+        values, extra = _split(test, TEST_COLUMNS)
+        rows.append([visit_id, position] + values + [extra])
+    conn.executemany(
+        f"INSERT INTO visit_tests (visit_id, position, {', '.join(TEST_COLUMNS)}, extra) VALUES (?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+
+
+def _visit_row(conn, entry):
+    # Returns (row id, position) for the visit an edit / delete entry addresses
+    if "id" in entry:
+        row = conn.execute("SELECT id, seq FROM visits WHERE uid = ?", (entry["id"],)).fetchone()
+    else:
+        row = conn.execute("SELECT id, seq FROM visits WHERE seq = ?", (entry["index"],)).fetchone()
+    if row is None:
+        raise KeyError(entry.get("id", entry.get("index")))
+    return row
+
+
+def read(conn, table):
+    if table in KEY_COLUMNS:
+        key, value = KEY_COLUMNS[table]
+        return dict(conn.execute(f"SELECT {key}, {value} FROM {table} ORDER BY rowid"))
+
+    tests = {}
+    for row in conn.execute(
+        f"SELECT visit_id, {', '.join(TEST_COLUMNS)}, extra FROM visit_tests ORDER BY visit_id, position"
+    ):
+        tests.setdefault(row[0], []).append(_join(TEST_COLUMNS, row[1:-1], row[-1]))
+
+    visits = []
+    for row in conn.execute(f"SELECT id, uid, {', '.join(VISIT_COLUMNS)}, extra FROM visits ORDER BY seq"):
+        record = _join(VISIT_COLUMNS, row[2:-1], row[-1], row[1])
+        record["tests"] = tests.get(row[0], [])
+        visits.append(record)
+    return visits
+
+
+def replace(conn, table, data):
+    conn.execute(f"DELETE FROM {table}")
+    if table in KEY_COLUMNS:
+        key, value = KEY_COLUMNS[table]
+        conn.executemany(f"INSERT INTO {table} ({key}, {value}) VALUES (?, ?)", list(data.items()))
+    else:
+        for seq, record in enumerate(data):
+            _insert_visit(conn, seq, record)
+    _bump_version(conn, table)
+
+
+def apply_entry(conn, table, entry):
+    _apply_entry(conn, table, entry)
+    _bump_version(conn, table)
+
+
+def load(db_path, table):
+    with reading(db_path) as conn:
+        return read(conn, table)
+
+
+def save(db_path, table, data):
+    with writing(db_path) as conn:
+        replace(conn, table, data)
+
+
+def apply(db_path, table, entry):
+    with writing(db_path) as conn:
+        apply_entry(conn, table, entry)
+
+
+def _apply_entry(conn, table, entry):
+    op = entry["op"]
+    if op == "add":
+        seq = conn.execute("SELECT COUNT(*) FROM visits").fetchone()[0]
+        _insert_visit(conn, seq, entry["record"])
+    elif op == "extend":
+        seq = conn.execute("SELECT COUNT(*) FROM visits").fetchone()[0]
+        for offset, record in enumerate(entry["records"]):
+            _insert_visit(conn, seq + offset, record)
+    elif op == "edit":
+        visit_id, _ = _visit_row(conn, entry)
+        record = entry["record"]
+        values, extra = _split(record, VISIT_COLUMNS)
+        conn.execute(
+            f"UPDATE visits SET uid = ?, name_norm = ?, {', '.join(col + ' = ?' for col in VISIT_COLUMNS)}, extra = ? "
+            f"WHERE id = ?",
+            [record.get("id"), normalize_name(record.get("name", ""))] + values + [extra, visit_id],
+        )
+        conn.execute("DELETE FROM visit_tests WHERE visit_id = ?", (visit_id,))
+        _insert_tests(conn, visit_id, record.get("tests", []))
+    elif op == "delete":
+        visit_id, seq = _visit_row(conn, entry)
+        conn.execute("DELETE FROM visits WHERE id = ?", (visit_id,))
+        conn.execute("UPDATE visits SET seq = seq - 1 WHERE seq > ?", (seq,))
+    elif op == "set":
+        key, value = KEY_COLUMNS[table]
+        conn.execute(
+            f"INSERT INTO {table} ({key}, {value}) VALUES (?, ?) ON CONFLICT({key}) DO UPDATE SET {value} = excluded.{value}",
+            (entry["key"], entry["value"]),
+        )
+    elif op == "pop":
+        key, _ = KEY_COLUMNS[table]
+        conn.execute(f"DELETE FROM {table} WHERE {key} = ?", (entry["key"],))
+    elif op == "batch":
+        # One connection, one transaction for the whole batch
+        for sub_entry in entry["entries"]:
+            _apply_entry(conn, table, sub_entry)
+
+
+def find_visits(conn, start_date, end_date, search=""):
+    # (uid, seq) of the matching visits in storage order; the date range is served by
+    # idx_visits_date, name / phone prefixes by their own indexes
+    sql = "SELECT uid, seq FROM visits WHERE date BETWEEN ? AND ?"
+    params = [start_date.isoformat(), end_date.isoformat()]
+    if search:
+        name_prefix = normalize_name(search)
+        sql += " AND ((name_norm >= ? AND name_norm < ?) OR (phone >= ? AND phone < ?))"
+        params += [name_prefix, name_prefix + "\uffff", search, search + "\uffff"]
+    return conn.execute(sql + " ORDER BY seq", params).fetchall()
+
+
+def migrate_from_json(data_dir, db_path=None):
+    from Utils import Partitions
+    from Utils.Storage import load_json_file
+
+    db_path = db_path or os.path.join(data_dir, "clinic.db")
+    for filename, table in TABLES.items():
+        if table == "visits" and Partitions.months(data_dir):
+            # Monthly files written by the JSON backend, oldest first
+            data = [record for month in Partitions.months(data_dir)
+                    for record in load_json_file(Partitions.partition_file(data_dir, month), [])]
+        else:
+            data = load_json_file(os.path.join(data_dir, filename), [] if table == "visits" else {})
+        save(db_path, table, data)
+    return db_path
+
+
+if __name__ == "__main__":
+    # python -m Utils.Database <data_dir> [db_path]
+    if len(sys.argv) < 2:
+        print("usage: python -m Utils.Database <data_dir> [db_path]")
+        sys.exit(1)
+    print(f"Migrated into {migrate_from_json(sys.argv[1], *sys.argv[2:3])}")
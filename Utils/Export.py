@@ -1,23 +1,86 @@
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+import gzip
+import io
 
-def patients_to_xml(patients):
-    root = ET.Element("Patients")
+from Utils.Profiling import count, timed
+
+XML_HEADER = '<?xml version="1.0" ?>\n'
+
+
+def _escape(value):
+    # Same escaping (and newline normalisation) the old minidom pretty-printer produced
+    text = str(value).replace("\r\n", "\n").replace("\r", "\n")
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def _element(tag, value, pad, newline):
+    text = _escape(value)
+    if text:
+        return f"{pad}<{tag}>{text}</{tag}>{newline}"
+    return f"{pad}<{tag}/>{newline}"
+
+
+def patient_to_xml(patient, indent="  ", level=1):
+    indent = indent or ""
+    newline = "\n" if indent else ""
+    pad = indent * level
+    parts = [f"{pad}<Patient>{newline}"]
+    for key, value in patient.items():
+        if key == "tests":
+            if not value:
+                parts.append(f"{pad}{indent}<Tests/>{newline}")
+                continue
+            parts.append(f"{pad}{indent}<Tests>{newline}")
+            for test in value:
+                parts.append(f"{pad}{indent * 2}<Test>{newline}")
+                for tk, tv in test.items():
+                    parts.append(_element(tk, tv, pad + indent * 3, newline))
+                parts.append(f"{pad}{indent * 2}</Test>{newline}")
+            parts.append(f"{pad}{indent}</Tests>{newline}")
+        else:
+            parts.append(_element(key, value, pad + indent, newline))
+    parts.append(f"{pad}</Patient>{newline}")
+    return "".join(parts)
+
+
+PROGRESS_EVERY = 1000
+
+
+def write_patients_xml(patients, f, indent="  ", progress=None):
+    # Streams one <Patient> at a time so memory stays flat however many records there are;
+    # progress(records written) is called every PROGRESS_EVERY records
+    newline = "\n" if indent else ""
+    f.write(XML_HEADER)
+    written = 0
     for patient in patients:
-        p_elem = ET.SubElement(root, "Patient")
-        for key, value in patient.items():
-            if key == "tests":
-                tests_elem = ET.SubElement(p_elem, "Tests")
-                for test in value:
-                    test_elem = ET.SubElement(tests_elem, "Test")
-                    for tk, tv in test.items():
-                        ET.SubElement(test_elem, tk).text = str(tv)
-            else:
-                ET.SubElement(p_elem, key).text = str(value)
-
-    # Convert to a string and pretty print
-    rough_string = ET.tostring(root, encoding="utf-8")
-    reparsed = minidom.parseString(rough_string)
-    pretty_xml = reparsed.toprettyxml(indent="  ")
-
-    return pretty_xml
+        if written == 0:
+            f.write(f"<Patients>{newline}")
+        f.write(patient_to_xml(patient, indent))
+        written += 1
+        if progress and written % PROGRESS_EVERY == 0:
+            progress(written)
+    f.write(f"</Patients>{newline}" if written else f"<Patients/>{newline}")
+    count("records_exported", written)
+    return written
+
+
+def open_xml(path, mode="r", compress=None):
+    if compress is None:
+        compress = path.endswith(".gz")
+    if "b" in mode:
+        return gzip.open(path, mode) if compress else open(path, mode)
+    if compress:
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+@timed()
+def export_patients_xml(patients, path, indent="  ", compress=None, progress=None):
+    with open_xml(path, "w", compress) as f:
+        return write_patients_xml(patients, f, indent, progress)
+
+
+@timed()
+def patients_to_xml(patients):
+    buffer = io.StringIO()
+    write_patients_xml(patients, buffer)
+    return buffer.getvalue()
@@ -0,0 +1,261 @@
+import argparse
+import csv
+import datetime
+import json
+import os
+import re
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from Utils import Billing, Partitions, Patients, Storage
+from Utils.Backup import iter_backup, restore_types
+from Utils.Profiling import count, timed
+from Utils.Storage import get_record, new_record_id, save_json
+
+# Records are read one at a time and checked in batches of BATCH_SIZE (optionally in
+# worker processes). Good records are staged to disk per month, so an import never
+# holds more than a few batches of the source file, and each month's share is then
+# committed as a single journal entry.
+BATCH_SIZE = 1000
+NUMBER_FIELDS = ("age", "consultation_fee", "total_amount")
+CHUNK_SIZE = 1024 * 1024
+# Whitespace, commas and brackets between the records of a JSON array or JSON lines
+SEPARATORS = re.compile(r"[ \t\r\n,\[\]]*")
+
+
+def iter_xml(path):
+    # Full backups and the records added by a delta; deletions only matter to a chain restore
+    for kind, record in iter_backup(path):
+        if kind == "patient":
+            yield restore_types(record)
+
+
+def iter_json(path):
+    # A JSON array or JSON lines, decoded object by object from a rolling buffer;
+    # pos moves through the buffer and what's been decoded is only cut off per chunk
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    array = closed = None
+    with open(path, encoding="utf-8") as f:
+        eof = False
+        while True:
+            end = SEPARATORS.match(buffer, pos).end()
+            if end > pos:
+                skipped = buffer[pos:end]
+                if array is None:
+                    array = skipped.lstrip().startswith("[")
+                closed = closed or "]" in skipped
+                pos = end
+            elif pos < len(buffer) and array is None:
+                array = False
+            if pos < len(buffer):
+                try:
+                    record, pos = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                else:
+                    yield record
+                    continue
+            if eof:
+                if array and not closed:
+                    raise ValueError(f"{path} ends before the JSON array is closed (truncated?)")
+                return
+            chunk = f.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
+def _csv_tests(text):
+    # Either a JSON list of tests or "name:cost" pairs separated by ";"
+    text = (text or "").strip()
+    if not text:
+        return []
+    if text.startswith("["):
+        return json.loads(text)
+    tests = []
+    for item in text.split(";"):
+        name, sep, cost = item.partition(":")
+        tests.append({"name": name.strip(), "value": "", "cost": cost.strip() if sep else 0})
+    return tests
+
+
+def iter_csv(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            record = {key: value for key, value in row.items() if key and value is not None}
+            record["tests"] = _csv_tests(record.get("tests"))
+            yield restore_types(record)
+
+
+READERS = {".xml": iter_xml, ".gz": iter_xml, ".json": iter_json, ".jsonl": iter_json, ".csv": iter_csv}
+
+
+def normalize(record):
+    # The first version of the form stored the visit date as "dob" and had no gender / time
+    record = dict(record)
+    if "dob" in record:
+        dob = record.pop("dob")
+        record.setdefault("date", dob)
+    record.setdefault("tests", [])
+    return record
+
+
+def validate(record):
+    problems = []
+    try:
+        datetime.date.fromisoformat(record.get("date", ""))
+    except (TypeError, ValueError):
+        problems.append(f"bad date {record.get('date')!r}")
+    for field in NUMBER_FIELDS:
+        if field in record and not isinstance(record[field], int):
+            problems.append(f"{field} is not a whole number: {record[field]!r}")
+    if not isinstance(record.get("tests"), list):
+        problems.append("tests is not a list")
+    else:
+        for test in record["tests"]:
+            if not isinstance(test, dict) or not test.get("name"):
+                problems.append(f"test without a name: {test!r}")
+            elif not isinstance(test.get("cost", 0), int):
+                problems.append(f"test {test['name']} cost is not a whole number: {test['cost']!r}")
+    return problems
+
+
+def check_batch(batch):
+    # batch is [(row number, raw record)]; returns (good records, [(row, record, problems)])
+    good, bad = [], []
+    for row, record in batch:
+        try:
+            record = normalize(record)
+            problems = validate(record)
+        except Exception as exc:
+            problems = [f"unreadable record: {exc}"]
+        if problems:
+            bad.append((row, record, problems))
+        else:
+            good.append(record)
+    return good, bad
+
+
+def _batches(records, batch_size):
+    batch = []
+    for row, record in enumerate(records, 1):
+        batch.append((row, record))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _checked(batches, workers):
+    # Results come back in file order; at most 2 * workers batches are in flight
+    if not workers:
+        for batch in batches:
+            yield check_batch(batch)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.submit(check_batch, batch))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _read_staged(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def _stage(path, data_dir, staging, replace, workers, batch_size):
+    # Checks the whole source into per-partition JSON lines files under staging.
+    # Returns ({partition file: staged file}, report); nothing in data_dir is touched.
+    suffix = os.path.splitext(path)[1].lower()
+    staged = {}
+    handles = {}
+    ids = {}  # partition file -> ids taken by this import
+    report = {"imported": 0, "rejected": []}
+    try:
+        for good, bad in _checked(_batches(READERS[suffix](path), batch_size), workers):
+            for record in good:
+                filepath = Partitions.file_for(data_dir, record.get("date"))
+                taken = ids.setdefault(filepath, set())
+                # Ids already used in the partition (unless it's being replaced; a month with no file yet
+                # has none) or earlier in this file get a new one
+                if (not record.get("id") or record["id"] in taken
+                        or (not replace and os.path.exists(filepath)
+                            and get_record(filepath, Partitions.load_partition(filepath), record["id"]) is not None)):
+                    record["id"] = new_record_id()
+                taken.add(record["id"])
+                if filepath not in handles:
+                    staged[filepath] = os.path.join(staging, f"{len(staged)}.jsonl")
+                    handles[filepath] = open(staged[filepath], "w", encoding="utf-8")
+                handles[filepath].write(json.dumps(record) + "\n")
+            report["imported"] += len(good)
+            report["rejected"].extend(bad)
+            count("records_imported", len(good))
+    finally:
+        for handle in handles.values():
+            handle.close()
+    return staged, report
+
+
+@timed()
+def import_file(path, data_dir, replace=False, workers=0, batch_size=BATCH_SIZE):
+    # Returns {"imported": n, "rejected": [(row, record, problems)]}. The whole source is
+    # read and checked into a staging directory first, so a file that fails to parse part
+    # way leaves the existing visits untouched; only then are they replaced or added to,
+    # one partition at a time, and earnings and the patient index rebuilt.
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix not in READERS:
+        raise ValueError(f"don't know how to import {path} (expected .xml, .xml.gz, .json, .jsonl or .csv)")
+
+    staging = tempfile.mkdtemp(prefix="import.", dir=data_dir)
+    committing = False
+    try:
+        staged, report = _stage(path, data_dir, staging, replace, workers, batch_size)
+        committing = True
+        if replace:
+            for filepath in Partitions.partition_files(data_dir):
+                if filepath not in staged:
+                    save_json(filepath, [])
+            for filepath, staged_path in staged.items():
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                save_json(filepath, _read_staged(staged_path))
+        else:
+            for filepath, staged_path in staged.items():
+                Storage.append_records(filepath, Partitions.load_partition(filepath), _read_staged(staged_path))
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+        if committing:
+            # Also after a failure part way through, so earnings match whatever was written
+            Billing.rebuild_files(data_dir)
+            Patients.rebuild_files(data_dir)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import visits from an XML backup, JSON or CSV file")
+    parser.add_argument("file", help=".xml / .xml.gz backup, .json / .jsonl or .csv")
+    parser.add_argument("data_dir")
+    parser.add_argument("--replace", action="store_true", help="replace all existing visits (restore)")
+    parser.add_argument("--workers", type=int, default=0, help="validate batches in this many processes")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--rejects", default=None, help="write rejected rows to this JSON file")
+    args = parser.parse_args()
+
+    result = import_file(args.file, args.data_dir, replace=args.replace, workers=args.workers,
+                         batch_size=args.batch_size)
+    print(f"Imported {result['imported']} record(s), rejected {len(result['rejected'])}")
+    for row, _, problems in result["rejected"][:20]:
+        print(f"  row {row}: {'; '.join(problems)}")
+    if args.rejects:
+        with open(args.rejects, "w") as f:
+            json.dump([{"row": row, "record": record, "problems": problems}
+                       for row, record, problems in result["rejected"]], f, indent=4)
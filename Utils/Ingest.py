@@ -0,0 +1,386 @@
+import argparse
+import csv
+import hmac
+import io
+import json
+import os
+from collections import defaultdict
+from contextlib import ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from Utils import Billing, Partitions, Patients
+from Utils.Database import normalize_name
+from Utils.Import import normalize, validate
+from Utils.Storage import file_lock, get_record, load_json, new_record_id, write_batch
+
+# Headless entry point for lab machines and scripts. A batch is a list of items:
+#   {"op": "result",   <match>, "test": "SGPT", "value": "42"}     fill in a test result
+#   {"op": "add_test", <match>, "test": "CBC", "value": "", "cost": 300}   cost defaults to the catalog
+#   {"op": "visit",    "record": {...}}                             add a whole visit
+#   {"op": "price",    "test": "CBC", "cost": 350}                  add / change a catalog price
+# <match> is "id", or "phone" with an optional "date" and "name" to narrow it down.
+# CSV uploads have one item per row (columns op, id, phone, date, name, test, value, cost;
+# op defaults to "result"). The whole batch is checked before anything is written and
+# each data file then takes its share as one journal entry. Without an api_token in
+# admin_config.json the HTTP service only listens on, and answers, this machine.
+DEFAULT_PORT = 8765
+MAX_BODY = 16 * 1024 * 1024
+LOOPBACK = ("127.0.0.1", "::1", "localhost")
+VISIT_OPS = ("result", "add_test")
+
+
+class BatchError(Exception):
+    pass
+
+
+def parse_csv(text):
+    items = []
+    for row in csv.DictReader(io.StringIO(text)):
+        item = {key: value.strip() for key, value in row.items() if key and value and value.strip()}
+        item.setdefault("op", "result")
+        if "cost" in item:
+            try:
+                item["cost"] = int(item["cost"])
+            except ValueError:
+                pass  # reported by check_item
+        items.append(item)
+    return items
+
+
+def parse_batch(raw, content_type="application/json"):
+    if "csv" in content_type:
+        return parse_csv(raw)
+    batch = json.loads(raw)
+    return batch["items"] if isinstance(batch, dict) else batch
+
+
+class _Matcher:
+    # Id and phone lookups for one batch; each month's phone map and the id -> date map
+    # from the patient index are built the first time they're needed
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.by_month = {}
+        self.dates = None
+        self.index = Patients.load_index(data_dir)
+
+    def _phones(self, filepath):
+        phones = self.by_month.get(filepath)
+        if phones is None:
+            phones = self.by_month[filepath] = defaultdict(list)
+            for record in Partitions.load_partition(filepath):
+                phones[Patients.phone_key(record.get("phone"))].append(record)
+        return phones
+
+    def _by_id(self, record_id, date):
+        if date:
+            files = [Partitions.file_for(self.data_dir, date)]
+        else:
+            if self.dates is None:
+                self.dates = {visit_id: day for entry in list(self.index.values()) for day, visit_id in entry["visits"]}
+            files = Partitions.partition_files(self.data_dir)
+            if record_id in self.dates:
+                # The month the index lists is read first; the others only if it's behind
+                # or the visit has no phone or name to be indexed under
+                known = Partitions.file_for(self.data_dir, self.dates[record_id])
+                files = [known] + [filepath for filepath in files if filepath != known]
+        for filepath in files:
+            record = get_record(filepath, Partitions.load_partition(filepath), record_id)
+            if record is not None:
+                return filepath, record
+        raise BatchError(f"no visit with id {record_id}")
+
+    def find(self, item):
+        if item.get("id"):
+            return self._by_id(item["id"], item.get("date"))
+        phone = Patients.phone_key(item.get("phone"))
+        if not phone:
+            raise BatchError("needs an id or a phone number to find the visit")
+
+        date = item.get("date")
+        entry = self.index.get(f"p:{phone}")
+        if date:
+            files = [Partitions.file_for(self.data_dir, date)]
+        elif entry:
+            # Only the months the patient index says they came in, newest first
+            files = list(dict.fromkeys(Partitions.file_for(self.data_dir, day) for day, _ in reversed(entry["visits"])))
+        else:
+            files = Partitions.partition_files(self.data_dir)[::-1]
+        for filepath in files:
+            candidates = [record for record in self._phones(filepath).get(phone, [])
+                          if (not date or record.get("date") == date)
+                          and (not item.get("name") or normalize_name(record.get("name", "")) == normalize_name(item["name"]))]
+            if item.get("op") == "result":
+                candidates = [record for record in candidates if _find_test(record, item.get("test"))] or candidates
+            if not candidates:
+                continue
+            if date and len(candidates) > 1:
+                raise BatchError(f"{len(candidates)} visits on {date} for phone {phone}; give the id or name")
+            # Without a date the most recent visit wins
+            return filepath, max(candidates, key=lambda record: (record.get("date", ""), record.get("time", "")))
+        raise BatchError(f"no visit for phone {phone}" + (f" on {date}" if date else ""))
+
+
+def _find_test(record, name):
+    tests = [test for test in record.get("tests", []) if test.get("name") == name]
+    # A repeated test gets the result in its first empty slot
+    return next((test for test in tests if not test.get("value")), tests[0] if tests else None)
+
+
+def apply_item(record, item):
+    # Returns the updated copy of a visit; raises BatchError if the item doesn't fit it
+    updated = dict(record)
+    updated["tests"] = [dict(test) for test in record.get("tests", [])]
+    name = item.get("test")
+    if item["op"] == "result":
+        test = _find_test(updated, name)
+        if test is None:
+            raise BatchError(f"visit {record['id']} has no {name} test (use add_test)")
+        test["value"] = str(item.get("value", ""))
+    else:
+        updated["tests"].append({"name": name, "value": str(item.get("value", "")), "cost": item["cost"]})
+        updated["total_amount"] = updated.get("total_amount", 0) + item["cost"]
+    return updated
+
+
+def check_item(item):
+    op = item.get("op")
+    if op in VISIT_OPS:
+        if not item.get("test"):
+            raise BatchError(f"{op} needs a test name")
+        if op == "add_test" and "cost" in item and (not isinstance(item["cost"], int) or item["cost"] < 0):
+            raise BatchError("cost must be a whole number")
+    elif op == "price":
+        if not item.get("test") or not isinstance(item.get("cost"), int) or item["cost"] < 0:
+            raise BatchError("price needs a test name and a whole-number cost")
+    elif op == "visit":
+        if not isinstance(item.get("record"), dict):
+            raise BatchError("visit needs a record")
+        problems = validate(normalize(item["record"]))
+        if problems:
+            raise BatchError("; ".join(problems))
+    else:
+        raise BatchError(f"unknown op {op!r}")
+
+
+def plan(data_dir, items, catalog):
+    # Resolves every item against the data as it is now. Returns
+    # ({filepath: [(record id or None, item)]}, {test: cost}, [errors])
+    matcher = _Matcher(data_dir)
+    by_file = defaultdict(list)
+    prices = {}
+    errors = []
+    pending = {}  # record id -> updated copy, so several items on one visit build on each other
+    for number, item in enumerate(items, 1):
+        try:
+            if not isinstance(item, dict):
+                raise BatchError("item is not an object")
+            check_item(item)
+            if item["op"] == "add_test" and "cost" not in item:
+                # Priced now, so a later price item in the same batch doesn't change it
+                cost = prices.get(item["test"], catalog.get(item["test"]))
+                if cost is None:
+                    raise BatchError(f"{item['test']} is not in the test catalog; give its cost")
+                item = dict(item, cost=cost)
+            if item["op"] == "price":
+                prices[item["test"]] = item["cost"]
+            elif item["op"] == "visit":
+                record = normalize(item["record"])
+                by_file[Partitions.file_for(data_dir, record.get("date"))].append((None, dict(item, record=record)))
+            else:
+                filepath, record = matcher.find(item)
+                pending[record["id"]] = apply_item(pending.get(record["id"], record), item)
+                by_file[filepath].append((record["id"], item))
+        except BatchError as exc:
+            errors.append({"item": number, "error": str(exc)})
+    return by_file, prices, errors
+
+
+def _entries(filepath, records, planned):
+    # One file's share of the batch, worked out against its records as they are now:
+    # returns (journal entries, [(old, new)] visit changes)
+    updated = {}
+    originals = {}
+    added = []
+    for record_id, item in planned:
+        if record_id is None:
+            record = dict(item["record"])
+            if not record.get("id") or get_record(filepath, records, record["id"]) is not None:
+                record["id"] = new_record_id()
+            added.append(record)
+            continue
+        current = updated.get(record_id)
+        if current is None:
+            current = get_record(filepath, records, record_id)
+            if current is None:
+                raise BatchError(f"visit {record_id} was deleted while the batch was being applied")
+            originals[record_id] = current
+        updated[record_id] = apply_item(current, item)
+
+    entries = [{"op": "edit", "id": record_id, "record": record} for record_id, record in updated.items()]
+    entries += [{"op": "add", "record": record} for record in added]
+    changes = [(originals[record_id], record) for record_id, record in updated.items()]
+    changes += [(None, record) for record in added]
+    return entries, changes
+
+
+def _costs(record):
+    return [test.get("cost") for test in record.get("tests", [])]
+
+
+def apply_batch(data_dir, items, partial=False):
+    # Applies a batch and returns a report. Unless partial is set, any bad item stops
+    # the whole batch before anything is written. Every file the batch touches is
+    # locked and its share worked out against current data before the first write,
+    # so nothing another terminal does can fail it half way; each file's share (and
+    # the earnings, rollup and patient index updates) is then one journal entry.
+    tests_file = os.path.join(data_dir, "tests.json")
+    rollup_file = os.path.join(data_dir, Billing.ROLLUP_FILE)
+    earnings_file = os.path.join(data_dir, "earnings.json")
+    index_file = os.path.join(data_dir, Patients.INDEX_FILE)
+
+    by_file, prices, errors = plan(data_dir, items, load_json(tests_file, {}))
+    report = {"items": len(items), "errors": errors, "committed": False,
+              "visits_updated": 0, "visits_added": 0, "prices_set": 0}
+    if errors and not partial:
+        return report
+
+    with ExitStack() as locks:
+        # Always taken in path order, so two batches can't deadlock
+        for path in sorted(set(by_file) | {tests_file, rollup_file, earnings_file, index_file}):
+            locks.enter_context(file_lock(path))
+
+        staged = []
+        for filepath, planned in by_file.items():
+            records = Partitions.load_partition(filepath)
+            try:
+                staged.append((filepath, records) + _entries(filepath, records, planned))
+            except BatchError as exc:
+                report["errors"].append({"file": os.path.basename(filepath), "error": str(exc)})
+        if report["errors"] and not partial:
+            return report
+
+        changes = []
+        for filepath, records, entries, file_changes in staged:
+            write_batch(filepath, records, lambda entries=entries: entries)
+            changes.extend(file_changes)
+        if prices:
+            write_batch(tests_file, load_json(tests_file, {}),
+                        lambda: [{"op": "set", "key": name, "value": cost} for name, cost in prices.items()])
+
+        # Result-only changes leave the earnings as they are
+        billed = [(old, new) for old, new in changes if old is None or _costs(old) != _costs(new)]
+        rollup = load_json(rollup_file, {})
+        Billing.record_visits(rollup_file, rollup, billed)
+        Billing.sync_days(earnings_file, load_json(earnings_file, {}), rollup, [new["date"] for _, new in billed])
+        Patients.record_visits(index_file, Patients.load_index(data_dir),
+                               [(None, new) for old, new in changes if old is None])
+
+    report["visits_added"] = sum(old is None for old, _ in changes)
+    report["visits_updated"] = len(changes) - report["visits_added"]
+    report["prices_set"] = len(prices)
+    report["committed"] = True
+    return report
+
+
+def _token(data_dir):
+    config_path = os.path.join(data_dir, "admin_config.json")
+    config = load_json(config_path, {}) if os.path.exists(config_path) else {}
+    return config.get("api_token")
+
+
+def make_handler(data_dir):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            raw = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def _authorized(self):
+            token = _token(data_dir)
+            if token is None:
+                if self.client_address[0] in LOOPBACK:
+                    return True
+                self._reply(403, {"error": "set api_token in admin_config.json to accept batches from other machines"})
+                return False
+            given = self.headers.get("X-Api-Token") or ""
+            if not hmac.compare_digest(given.encode("utf-8"), str(token).encode("utf-8")):
+                self._reply(401, {"error": "missing or wrong X-Api-Token"})
+                return False
+            return True
+
+        def do_GET(self):
+            if urlparse(self.path).path != "/health":
+                return self._reply(404, {"error": "not found"})
+            self._reply(200, {"status": "ok", "months": len(Partitions.months(data_dir))})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/batch":
+                return self._reply(404, {"error": "not found"})
+            if not self._authorized():
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                return self._reply(400, {"error": "bad Content-Length"})
+            if length > MAX_BODY:
+                return self._reply(413, {"error": f"batch is over {MAX_BODY // (1024 * 1024)} MB; split it up"})
+            try:
+                raw = self.rfile.read(length).decode("utf-8")
+                items = parse_batch(raw, self.headers.get("Content-Type", "application/json"))
+            except (ValueError, KeyError, TypeError) as exc:
+                return self._reply(400, {"error": f"unreadable batch: {exc}"})
+            partial = parse_qs(url.query).get("partial", ["0"])[0] in ("1", "true")
+            try:
+                report = apply_batch(data_dir, items, partial=partial)
+            except Exception as exc:
+                # A write that failed part way (StaleWriteError, a full disk) still gets a JSON answer
+                self.log_error("batch failed: %r", exc)
+                return self._reply(500, {"error": f"batch failed: {exc}", "committed": False})
+            self._reply(200 if report["committed"] else 422, report)
+
+    return Handler
+
+
+def serve(data_dir, host="127.0.0.1", port=DEFAULT_PORT):
+    if host not in LOOPBACK and not _token(data_dir):
+        raise SystemExit(f"Refusing to serve on {host} without an api_token in admin_config.json")
+    server = ThreadingHTTPServer((host, port), make_handler(data_dir))
+    print(f"Listening on http://{host}:{port} (POST /batch, GET /health)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    # python -m Utils.Ingest apply <batch.json|batch.csv> <data_dir> [--partial]
+    # python -m Utils.Ingest serve <data_dir> [--host 127.0.0.1] [--port 8765]
+    parser = argparse.ArgumentParser(description="Headless batch updates for lab results, tests and prices")
+    commands = parser.add_subparsers(dest="command", required=True)
+    apply_cmd = commands.add_parser("apply", help="apply a batch file once")
+    apply_cmd.add_argument("file")
+    apply_cmd.add_argument("data_dir")
+    apply_cmd.add_argument("--partial", action="store_true", help="apply the good items even if some are bad")
+    serve_cmd = commands.add_parser("serve", help="accept batches over local HTTP")
+    serve_cmd.add_argument("data_dir")
+    serve_cmd.add_argument("--host", default="127.0.0.1")
+    serve_cmd.add_argument("--port", type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.data_dir, args.host, args.port)
+    else:
+        with open(args.file, encoding="utf-8") as f:
+            result = apply_batch(args.data_dir, parse_batch(f.read(), "csv" if args.file.endswith(".csv") else "json"),
+                                 partial=args.partial)
+        print(json.dumps(result, indent=4))
+        raise SystemExit(0 if result["committed"] else 1)
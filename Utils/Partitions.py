@@ -0,0 +1,186 @@
+import datetime
+import os
+import re
+import shutil
+import sys
+from collections import defaultdict
+
+from Utils import Storage
+from Utils.Records import Patient
+from Utils.Profiling import timed
+from Utils.Storage import ensure_ids, load_json, load_json_file, save_json
+
+# With the JSON backend visits live one file per month under Data/patients/
+# ("2026-10.json"), each an ordinary journaled Storage file. Screens ask for a
+# date range and only the months it reaches are loaded; the SQLite backend keeps
+# everything in one indexed table, so there patients.json is the only "partition".
+PARTITION_DIR = "patients"
+UNDATED = "undated"
+LEGACY_FILE = "patients.json"
+MIGRATED_SUFFIX = ".migrated"
+
+_MONTH_FILE = re.compile(r"^(\d{4}-\d{2}|" + UNDATED + r")\.json$")
+
+
+def is_patient_file(filepath):
+    name = os.path.basename(filepath)
+    return name == LEGACY_FILE or (os.path.basename(os.path.dirname(filepath)) == PARTITION_DIR
+                                   and _MONTH_FILE.match(name) is not None)
+
+
+Storage.register_record_type(is_patient_file, Patient.from_json)
+
+
+def enabled():
+    return Storage.BACKEND == "json"
+
+
+def partition_dir(data_dir):
+    return os.path.join(data_dir, PARTITION_DIR)
+
+
+def month_of(date):
+    # "2026-10-17" -> "2026-10"; anything that isn't a date goes to the undated partition
+    try:
+        return datetime.date.fromisoformat(str(date)).strftime("%Y-%m")
+    except ValueError:
+        return UNDATED
+
+
+def partition_file(data_dir, month):
+    return os.path.join(partition_dir(data_dir), f"{month}.json")
+
+
+def file_for(data_dir, date):
+    if not enabled():
+        return os.path.join(data_dir, LEGACY_FILE)
+    return partition_file(data_dir, month_of(date))
+
+
+def months(data_dir):
+    # Partitions on disk, oldest first, with the undated one (if any) last
+    if not os.path.isdir(partition_dir(data_dir)):
+        return []
+    found = [m.group(1) for m in map(_MONTH_FILE.match, os.listdir(partition_dir(data_dir))) if m]
+    return sorted(month for month in found if month != UNDATED) + [UNDATED] * (UNDATED in found)
+
+
+def partition_files(data_dir, start=None, end=None):
+    # Files holding visits between start and end (inclusive); no bounds means all of them
+    if not enabled():
+        return [os.path.join(data_dir, LEGACY_FILE)]
+    first = start.strftime("%Y-%m") if start else ""
+    last = end.strftime("%Y-%m") if end else "9999-99"
+    return [partition_file(data_dir, month) for month in months(data_dir)
+            if (month == UNDATED and start is None and end is None) or first <= month <= last]
+
+
+def load_partition(filepath):
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    records = load_json(filepath, [])
+    ensure_ids(filepath, records)
+    return records
+
+
+def iter_records(data_dir, start=None, end=None):
+    for filepath in partition_files(data_dir, start, end):
+        yield from load_partition(filepath)
+
+
+def load_all(data_dir):
+    # Whole history as one list, for backups and rebuilds
+    return list(iter_records(data_dir))
+
+
+def has_records(data_dir):
+    # Answered from file sizes so no partition has to be parsed
+    if not enabled():
+        return bool(load_partition(os.path.join(data_dir, LEGACY_FILE)))
+    return any(os.path.getsize(filepath) > len("[]") or os.path.exists(Storage.journal_path(filepath))
+               for filepath in partition_files(data_dir))
+
+
+@timed()
+def find_patients(data_dir, start_date, end_date, search=""):
+    # (partition file, record) pairs, oldest first, touching only the months in range.
+    # Dates were parsed to ordinals on load, so the filter is integer compares only.
+    if not enabled():
+        filepath = os.path.join(data_dir, LEGACY_FILE)
+        return [(filepath, record) for _, record in
+                Storage.find_patients(filepath, load_partition(filepath), start_date, end_date, search)]
+
+    first, last = start_date.toordinal(), end_date.toordinal()
+    needle = search.lower()
+    found = []
+    for filepath in partition_files(data_dir, start_date, end_date):
+        for record in load_partition(filepath):
+            day = record.day
+            if day is None or day < first or day > last:
+                continue
+            if not search or needle in (record.name or "").lower() or search in (record.phone or ""):
+                found.append((filepath, record))
+    return found
+
+
+def append_record(data_dir, record):
+    filepath = file_for(data_dir, record.get("date"))
+    Storage.append_record(filepath, load_partition(filepath), record)
+
+
+def append_records(data_dir, records):
+    # Each month's share of the batch is committed as one journal entry
+    by_file = defaultdict(list)
+    for record in records:
+        by_file[file_for(data_dir, record.get("date"))].append(record)
+    for filepath, batch in by_file.items():
+        Storage.append_records(filepath, load_partition(filepath), batch)
+
+
+def update_record(data_dir, record_id, record):
+    # The visit date can't be edited, so a record never changes partition
+    filepath = file_for(data_dir, record.get("date"))
+    Storage.update_record(filepath, load_partition(filepath), record_id, record)
+
+
+def delete_record(data_dir, record):
+    filepath = file_for(data_dir, record.get("date"))
+    Storage.delete_record(filepath, load_partition(filepath), record["id"])
+
+
+def clear(data_dir):
+    for filepath in partition_files(data_dir):
+        save_json(filepath, [])
+
+
+def migrate(data_dir):
+    # One-off split of Data/patients.json into monthly files; the original is kept
+    # as patients.json.migrated. Returns the number of months written.
+    legacy = os.path.join(data_dir, LEGACY_FILE)
+    if not enabled() or not os.path.exists(legacy) or os.path.isdir(partition_dir(data_dir)):
+        return 0
+    with Storage.file_lock(legacy):
+        if os.path.isdir(partition_dir(data_dir)):
+            return 0  # another process got here first
+        by_month = defaultdict(list)
+        for record in load_json_file(legacy, []):
+            by_month[month_of(record.get("date"))].append(record)
+        # Written to a side directory and renamed into place, so a crash part way leaves no partitions
+        staging = partition_dir(data_dir) + ".tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        for month, records in by_month.items():
+            save_json(os.path.join(staging, f"{month}.json"), records)
+        os.replace(staging, partition_dir(data_dir))
+        os.replace(legacy, legacy + MIGRATED_SUFFIX)
+        if os.path.exists(Storage.journal_path(legacy)):
+            os.remove(Storage.journal_path(legacy))
+    return len(by_month)
+
+
+if __name__ == "__main__":
+    # python -m Utils.Partitions <data_dir>
+    if len(sys.argv) != 2:
+        print("usage: python -m Utils.Partitions <data_dir>")
+        sys.exit(1)
+    written = migrate(sys.argv[1])
+    print(f"Split {LEGACY_FILE} into {written} monthly file(s)" if written else "Nothing to migrate")
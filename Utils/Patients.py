@@ -0,0 +1,189 @@
+import bisect
+import datetime
+import os
+import sys
+
+from Utils import Partitions
+from Utils.Database import normalize_name
+from Utils.Storage import get_record, load_json, save_json, write_batch
+
+# Master index of returning patients, one entry per person, kept next to the visit
+# partitions so a patient's whole history is found without scanning any month:
+#   "p:9876543210" -> keyed by the last 10 digits of the phone number
+#   "n:ram kumar"  -> name fallback for visits without a usable phone
+# Each entry is {"name", "age", "gender", "phone", "visits": [[date, id], ...]} with
+# the demographics of the latest visit and the visits oldest first. Like the earnings
+# rollup, the keys a change touches are re-read under the lock and journaled together.
+INDEX_FILE = "patient_index.json"
+DEMOGRAPHICS = ("name", "age", "gender", "phone")
+SUGGEST_LIMIT = 10
+
+# index file -> (index object, [(key, search text)]) for suggest()
+_search = {}
+
+
+def phone_key(phone):
+    digits = "".join(ch for ch in str(phone or "") if ch.isdigit())
+    return digits[-10:]
+
+
+def patient_key(record):
+    phone = phone_key(record.get("phone"))
+    if len(phone) == 10:
+        return f"p:{phone}"
+    name = normalize_name(record.get("name") or "")
+    return f"n:{name}" if name else None
+
+
+def _visit(record):
+    return [record.get("date") or "", record["id"]]
+
+
+def _added(entry, record):
+    entry = {"visits": []} if entry is None else dict(entry, visits=list(entry["visits"]))
+    visit = _visit(record)
+    dates = [date for date, _ in entry["visits"]]
+    position = bisect.bisect_right(dates, visit[0])
+    entry["visits"].insert(position, visit)
+    if position == len(dates):
+        # Latest visit so far - its details are the ones the form should offer
+        entry.update({field: record.get(field) for field in DEMOGRAPHICS})
+    return entry
+
+
+def _removed(entry, record):
+    if entry is None:
+        return None
+    visits = [visit for visit in entry["visits"] if visit[1] != record["id"]]
+    return dict(entry, visits=visits) if visits else None
+
+
+def _record(index_file, index, changes):
+    # changes is [(record, _added or _removed)]; every key they touch goes into one journal entry
+    def make_entries():
+        updated = {}
+        for record, change in changes:
+            key = patient_key(record)
+            if key is not None and record.get("id"):
+                updated[key] = change(updated[key] if key in updated else index.get(key), record)
+        return [{"op": "set", "key": key, "value": entry} if entry is not None else {"op": "pop", "key": key}
+                for key, entry in updated.items() if entry is not None or key in index]
+
+    write_batch(index_file, index, make_entries)
+    _search.pop(index_file, None)
+
+
+def add_visit(index_file, index, record):
+    _record(index_file, index, [(record, _added)])
+
+
+def remove_visit(index_file, index, record):
+    _record(index_file, index, [(record, _removed)])
+
+
+def edit_visit(index_file, index, old, new):
+    # A changed phone or name moves the visit to another patient
+    _record(index_file, index, [(old, _removed), (new, _added)])
+
+
+def record_visits(index_file, index, changes):
+    # changes is [(old, new)] with old None for an added visit and new None for a removed one
+    batch = []
+    for old, new in changes:
+        if old is not None:
+            batch.append((old, _removed))
+        if new is not None:
+            batch.append((new, _added))
+    if batch:
+        _record(index_file, index, batch)
+
+
+def lookup(index, phone="", name=""):
+    entry = index.get(f"p:{phone_key(phone)}") if len(phone_key(phone)) == 10 else None
+    if entry is None and name:
+        entry = index.get(f"n:{normalize_name(name)}")
+    return entry
+
+
+def _search_rows(index_file, index):
+    cached = _search.get(index_file)
+    if cached is not None and cached[0] is index:
+        return cached[1]
+    # A snapshot of the items, since another session's write can change the shared index mid-loop
+    rows = sorted(((entry["visits"][-1][0], key, f"{normalize_name(entry.get('name') or '')} {entry.get('phone') or ''}")
+                   for key, entry in list(index.items())), reverse=True)
+    rows = [(key, text) for _, key, text in rows]
+    _search[index_file] = (index, rows)
+    return rows
+
+
+def suggest(index_file, index, text, limit=SUGGEST_LIMIT):
+    # Keys of patients whose name or phone contains the text, most recently seen first
+    needle = normalize_name(text)
+    if not needle:
+        return []
+    found = []
+    for key, haystack in _search_rows(index_file, index):
+        if needle in haystack:
+            found.append(key)
+            if len(found) >= limit:
+                break
+    return found
+
+
+def current_age(entry, today=None):
+    # Age at the last visit plus the whole years since
+    age = entry.get("age")
+    if not isinstance(age, int):
+        return age
+    try:
+        last = datetime.date.fromisoformat(entry["visits"][-1][0])
+    except ValueError:
+        return age
+    today = today or datetime.date.today()
+    return age + today.year - last.year - ((today.month, today.day) < (last.month, last.day))
+
+
+def history(data_dir, entry):
+    # The patient's visits, newest first; only the months they came in are loaded
+    visits = []
+    for date, record_id in reversed(entry["visits"]):
+        filepath = Partitions.file_for(data_dir, date)
+        record = get_record(filepath, Partitions.load_partition(filepath), record_id)
+        if record is not None:
+            visits.append(record)
+    return visits
+
+
+def rebuild(patients):
+    index = {}
+    for patient in sorted(patients, key=lambda patient: (patient.get("date") or "", patient.get("time") or "")):
+        key = patient_key(patient)
+        if key is not None and patient.get("id"):
+            index[key] = _added(index.get(key), patient)
+    return index
+
+
+def rebuild_files(data_dir):
+    index = rebuild(Partitions.iter_records(data_dir))
+    save_json(os.path.join(data_dir, INDEX_FILE), index)
+    return index
+
+
+def load_index(data_dir):
+    # Built from the visits the first time it's asked for
+    index_file = os.path.join(data_dir, INDEX_FILE)
+    index = load_json(index_file, {})
+    if not index and Partitions.has_records(data_dir):
+        rebuild_files(data_dir)
+        index = load_json(index_file, {})
+    return index
+
+
+if __name__ == "__main__":
+    # python -m Utils.Patients rebuild <data_dir>
+    if len(sys.argv) != 3 or sys.argv[1] != "rebuild":
+        print("usage: python -m Utils.Patients rebuild <data_dir>")
+        sys.exit(1)
+    rebuilt = rebuild_files(sys.argv[2])
+    print(f"Indexed {len(rebuilt)} patient(s), {sum(len(entry['visits']) for entry in rebuilt.values())} visit(s)")
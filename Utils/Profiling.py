@@ -0,0 +1,147 @@
+import datetime
+import functools
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Per-rerun timing. A rerun is opened by start_rerun() at the top of main.py and
+# collects every stage() / timed() call made from that script thread. Finished
+# reruns are kept process-wide for the Admin Panel diagnostics view.
+MAX_RERUNS = 200
+
+_reruns = deque(maxlen=MAX_RERUNS)
+_reruns_lock = threading.Lock()
+_rerun_count = 0
+_open = {}  # session key -> rerun still running (closed by the session's next rerun if cut short)
+_current = threading.local()
+
+
+def _now_ms():
+    return time.perf_counter() * 1000
+
+
+def start_rerun(session_key, page=None):
+    global _rerun_count
+    previous = _open.pop(session_key, None)
+    if previous is not None:
+        # st.rerun() / st.stop() end the script early, so close it at its last activity
+        _close(previous, interrupted=True)
+
+    with _reruns_lock:
+        _rerun_count += 1
+        number = _rerun_count
+    rerun = {
+        "rerun": number,
+        "session": session_key,
+        "started": datetime.datetime.now().isoformat(timespec="milliseconds"),
+        "page": page,
+        "stages": {},
+        "counters": {},
+        "_start": _now_ms(),
+        "_last": _now_ms(),
+        "_mark": None,
+    }
+    _open[session_key] = rerun
+    _current.rerun = rerun
+    return rerun
+
+
+def _add_stage(rerun, name, ms):
+    totals = rerun["stages"].setdefault(name, {"ms": 0.0, "calls": 0})
+    totals["ms"] = round(totals["ms"] + ms, 3)
+    totals["calls"] += 1
+
+
+def _close(rerun, interrupted=False):
+    end = _now_ms() if not interrupted else rerun["_last"]
+    if rerun["_mark"] is not None:
+        _add_stage(rerun, rerun["_mark"][0], end - rerun["_mark"][1])
+    rerun.pop("_mark")
+    rerun["total_ms"] = round(end - rerun.pop("_start"), 3)
+    rerun.pop("_last")
+    rerun["interrupted"] = interrupted
+    with _reruns_lock:
+        _reruns.append(rerun)
+
+
+def finish_rerun():
+    rerun = getattr(_current, "rerun", None)
+    if rerun is None:
+        return
+    _current.rerun = None
+    if _open.get(rerun["session"]) is rerun:
+        del _open[rerun["session"]]
+        _close(rerun)
+
+
+@contextmanager
+def stage(name):
+    rerun = getattr(_current, "rerun", None)
+    if rerun is None:
+        yield
+        return
+    start = _now_ms()
+    try:
+        yield
+    finally:
+        end = _now_ms()
+        _add_stage(rerun, name, end - start)
+        rerun["_last"] = end
+
+
+def mark(name):
+    # Starts a named stage that runs until the next mark() or the end of the rerun,
+    # for top-level page code that can't be wrapped in a with block
+    rerun = getattr(_current, "rerun", None)
+    if rerun is None:
+        return
+    now = _now_ms()
+    if rerun["_mark"] is not None:
+        _add_stage(rerun, rerun["_mark"][0], now - rerun["_mark"][1])
+    rerun["_mark"] = (name, now)
+    rerun["_last"] = now
+
+
+def set_page(page):
+    rerun = getattr(_current, "rerun", None)
+    if rerun is not None:
+        rerun["page"] = page
+
+
+def timed(name=None):
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(label):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, amount=1):
+    rerun = getattr(_current, "rerun", None)
+    if rerun is not None:
+        rerun["counters"][name] = rerun["counters"].get(name, 0) + amount
+
+
+def gauge(name, value):
+    rerun = getattr(_current, "rerun", None)
+    if rerun is not None:
+        rerun["counters"][name] = value
+
+
+def recent_reruns(limit=20):
+    with _reruns_lock:
+        return list(_reruns)[-limit:][::-1]
+
+
+def rerun_count():
+    return _rerun_count
+
+
+def export_json(reruns):
+    return json.dumps(reruns, indent=2)
@@ -0,0 +1,200 @@
+import datetime
+import sys
+from collections.abc import MutableMapping
+
+# Compact in-memory form of a visit. Records behave like the dicts stored in the
+# JSON files (p["name"], p.get("gender"), dict(p), items() in file order) but keep
+# their fields in __slots__, the visit date as a day ordinal and the time as minutes
+# past midnight. to_json() gives back exactly the dict that was read. Values that
+# don't parse (or keys the model doesn't know) are kept as-is in `extra`.
+PATIENT_FIELDS = ("id", "name", "age", "gender", "phone", "symptoms", "consultation_fee", "total_amount")
+TEST_FIELDS = ("name", "value", "cost")
+
+# One shared copy of each key layout, test name and gender string
+_layouts = {}
+_strings = {}
+
+
+def _layout(keys):
+    keys = tuple(keys)
+    return _layouts.setdefault(keys, keys)
+
+
+def shared(text):
+    if type(text) is not str:
+        return text
+    return _strings.setdefault(text, sys.intern(text))
+
+
+def use_catalog(catalog):
+    # Test names already in tests.json become the copies every record points at
+    for name in catalog:
+        shared(name)
+
+
+def _parse_date(value):
+    if type(value) is str and len(value) == 10:
+        try:
+            day = datetime.date.fromisoformat(value)
+        except ValueError:
+            return None
+        if day.isoformat() == value:
+            return day.toordinal()
+    return None
+
+
+def _parse_time(value):
+    if type(value) is str and len(value) == 5 and value[2] == ":" and value[:2].isdigit() and value[3:].isdigit():
+        hours, minutes = int(value[:2]), int(value[3:])
+        if hours < 24 and minutes < 60:
+            return hours * 60 + minutes
+    return None
+
+
+class TestResult(MutableMapping):
+    __slots__ = ("name", "value", "cost", "extra", "order")
+
+    def __init__(self, test):
+        self.name = self.value = self.cost = self.extra = None
+        self.order = _layout(test)
+        for key, value in test.items():
+            self._set(key, value)
+
+    def _set(self, key, value):
+        if key == "name":
+            self.name = shared(value)
+        elif key in TEST_FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __getitem__(self, key):
+        if key not in self.order:
+            raise KeyError(key)
+        if key in TEST_FIELDS:
+            return getattr(self, key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key not in self.order:
+            self.order = _layout(self.order + (key,))
+        self._set(key, value)
+
+    def __delitem__(self, key):
+        if key not in self.order:
+            raise KeyError(key)
+        self.order = _layout(k for k in self.order if k != key)
+        if key in TEST_FIELDS:
+            setattr(self, key, None)
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __repr__(self):
+        return f"TestResult({self.to_json()!r})"
+
+    def to_json(self):
+        return {key: self[key] for key in self.order}
+
+
+class Patient(MutableMapping):
+    __slots__ = PATIENT_FIELDS + ("tests", "day", "minute", "extra", "order")
+
+    def __init__(self, record):
+        self.id = self.name = self.age = self.gender = self.phone = self.symptoms = None
+        self.consultation_fee = self.total_amount = self.tests = None
+        self.day = self.minute = self.extra = None
+        self.order = _layout(record)
+        for key, value in record.items():
+            self._set(key, value)
+
+    @classmethod
+    def from_json(cls, record):
+        return record if isinstance(record, cls) else cls(record)
+
+    def _keep(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def _set(self, key, value):
+        if key == "date":
+            self.day = _parse_date(value)
+            if self.day is None:
+                self._keep(key, value)
+        elif key == "time":
+            self.minute = _parse_time(value)
+            if self.minute is None:
+                self._keep(key, value)
+        elif key == "tests":
+            self.tests = [TestResult(test) if isinstance(test, dict) else test for test in value] \
+                if isinstance(value, list) else value
+        elif key == "gender":
+            self.gender = shared(value)
+        elif key in PATIENT_FIELDS:
+            setattr(self, key, value)
+        else:
+            self._keep(key, value)
+
+    def __getitem__(self, key):
+        if key not in self.order:
+            raise KeyError(key)
+        if key == "date" and self.day is not None:
+            return datetime.date.fromordinal(self.day).isoformat()
+        if key == "time" and self.minute is not None:
+            return f"{self.minute // 60:02d}:{self.minute % 60:02d}"
+        if key in PATIENT_FIELDS or key == "tests":
+            return getattr(self, key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key not in self.order:
+            self.order = _layout(self.order + (key,))
+        elif self.extra is not None:
+            self.extra.pop(key, None)
+        self._set(key, value)
+
+    def __delitem__(self, key):
+        if key not in self.order:
+            raise KeyError(key)
+        self.order = _layout(k for k in self.order if k != key)
+        if key == "date":
+            self.day = None
+        elif key == "time":
+            self.minute = None
+        elif key in PATIENT_FIELDS or key == "tests":
+            setattr(self, key, None)
+        if self.extra is not None:
+            self.extra.pop(key, None)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __repr__(self):
+        return f"Patient({self.to_json()!r})"
+
+    def visit_date(self):
+        return datetime.date.fromordinal(self.day) if self.day is not None else None
+
+    def visit_datetime(self):
+        # Visits saved before times were recorded count as midnight; None if either part is unreadable
+        if self.day is None or ("time" in self.order and self.minute is None):
+            return None
+        return datetime.datetime.fromordinal(self.day) + datetime.timedelta(minutes=self.minute or 0)
+
+    def to_json(self):
+        record = {key: self[key] for key in self.order}
+        if isinstance(record.get("tests"), list):
+            record["tests"] = [test.to_json() if isinstance(test, TestResult) else test for test in record["tests"]]
+        return record
+
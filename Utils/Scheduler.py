@@ -0,0 +1,154 @@
+import datetime
+import os
+import threading
+import time
+
+from Utils import Partitions, Storage
+from Utils.Backup import KEEP_DAYS, KEEP_MIN, MANIFEST_FILE, prune_backups, run_backup
+from Utils.Storage import load_json
+
+# One background thread per server process takes backups on a timer, or once
+# enough visits have been written since the last one, so no session waits on
+# serialization. Backups started from the Backup page are queued onto the same
+# thread and report their progress through status(). Settings are read from
+# admin_config.json on every check:
+#   backup_interval_hours (0 = off), backup_after_writes (0 = off), backup_compress,
+#   backup_keep_days, backup_keep_min
+INTERVAL_HOURS = 24
+AFTER_WRITES = 500
+CHECK_SECONDS = 30
+
+_status = {
+    "state": "idle",  # idle / queued / running / failed
+    "trigger": None,
+    "last_run": None,
+    "last_file": None,
+    "last_error": None,
+    "next_run": None,
+    "writes_since": 0,
+    "done": 0,
+    "total": 0,
+}
+_status_lock = threading.Lock()
+_requests = []
+_wake = threading.Event()
+_thread = None
+_start_lock = threading.Lock()
+
+
+def settings(data_dir):
+    config_path = os.path.join(data_dir, "admin_config.json")
+    config = load_json(config_path, {}) if os.path.exists(config_path) else {}
+    return {
+        "interval_hours": config.get("backup_interval_hours", INTERVAL_HOURS),
+        "after_writes": config.get("backup_after_writes", AFTER_WRITES),
+        "compress": config.get("backup_compress", True),
+        "keep_days": config.get("backup_keep_days", KEEP_DAYS),
+        "keep_min": config.get("backup_keep_min", KEEP_MIN),
+    }
+
+
+def _update(**changes):
+    with _status_lock:
+        _status.update(changes)
+
+
+def status():
+    with _status_lock:
+        return dict(_status)
+
+
+def _patient_writes():
+    return sum(writes for filepath, (writes, _) in Storage.data_versions().items()
+               if Partitions.is_patient_file(filepath))
+
+
+def _snapshot(data_dir):
+    # Each month is read from disk under its lock, so no half-applied write is seen.
+    # The copies bypass the storage cache: a backup shouldn't leave the whole history
+    # in memory when sessions only keep recent months.
+    records = []
+    for filepath in Partitions.partition_files(data_dir):
+        records.extend(Storage.read_json(filepath, []))
+    return records
+
+
+def _run(data_dir, backup_dir, trigger, full, compress):
+    _update(state="running", trigger=trigger, done=0, total=0)
+    config = settings(data_dir)
+    try:
+        patients = _snapshot(data_dir)
+        # The manifest lock keeps backups from several server processes from interleaving
+        with Storage.file_lock(os.path.join(backup_dir, MANIFEST_FILE)):
+            filename = run_backup(patients, backup_dir, full=full, compress=compress,
+                                  progress=lambda done, total: _update(done=done, total=total))
+            prune_backups(backup_dir, config["keep_days"], config["keep_min"])
+    except Exception as exc:
+        _update(state="failed", last_error=f"{type(exc).__name__}: {exc}")
+        return False
+    _update(state="idle", last_run=datetime.datetime.now().isoformat(timespec="seconds"),
+            last_file=filename, last_error=None)
+    return True
+
+
+def _last_backup_time(backup_dir):
+    manifest = os.path.join(backup_dir, MANIFEST_FILE)
+    return os.path.getmtime(manifest) if os.path.exists(manifest) else 0
+
+
+def _loop(data_dir, backup_dir):
+    last_time = _last_backup_time(backup_dir)
+    last_writes = _patient_writes()
+    if last_time:
+        _update(last_run=datetime.datetime.fromtimestamp(last_time).isoformat(timespec="seconds"))
+    else:
+        # No backups yet: the first scheduled one is an interval after start-up, not during it
+        last_time = time.time()
+    while True:
+        config = settings(data_dir)
+        writes = _patient_writes() - last_writes
+        next_time = last_time + config["interval_hours"] * 3600 if config["interval_hours"] else None
+        _update(writes_since=writes,
+                next_run=datetime.datetime.fromtimestamp(next_time).isoformat(timespec="seconds") if next_time else None)
+
+        with _status_lock:
+            request = _requests.pop(0) if _requests else None
+        if request is not None:
+            run = ("manual",) + request
+        elif next_time is not None and time.time() >= next_time:
+            run = ("schedule", False, config["compress"])
+        elif config["after_writes"] and writes >= config["after_writes"]:
+            run = ("writes", False, config["compress"])
+        else:
+            run = None
+
+        if run is not None:
+            # The counters move on even after a failure so a broken backup isn't retried every check
+            last_writes += writes
+            last_time = time.time()
+            _run(data_dir, backup_dir, *run)
+            continue
+        _wake.wait(CHECK_SECONDS)
+        _wake.clear()
+
+
+def start(data_dir, backup_dir):
+    # Safe to call on every rerun; only the first call in a process starts the thread
+    global _thread
+    with _start_lock:
+        if _thread is not None and _thread.is_alive():
+            return False
+        _thread = threading.Thread(target=_loop, args=(data_dir, backup_dir), name="backup-scheduler", daemon=True)
+        _thread.start()
+        return True
+
+
+def request_backup(full=False, compress=False):
+    # Queues a backup on the scheduler thread; False if one is already queued or running
+    with _status_lock:
+        if _requests or _status["state"] in ("queued", "running"):
+            return False
+        _requests.append((full, compress))
+        _status.update(state="queued", trigger="manual", done=0, total=0)
+    _wake.set()
+    return True
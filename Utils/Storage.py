@@ -1,16 +1,796 @@
+import datetime
+import hashlib
 import json
 import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from Utils import Database
+from Utils.Profiling import count, timed
+
+# "json" keeps the plain files under Data/, "sqlite" serves patients / earnings /
+# tests from Data/clinic.db (run `python -m Utils.Database Data` once to migrate)
+BACKEND = os.environ.get("CLINIC_STORAGE_BACKEND", "json")
+SQLITE_FILE = "clinic.db"
+
+# Every add / edit / delete is appended to "<file>.journal" as one JSON line.
+# The first line of a journal names the digest of the snapshot it applies to,
+# so a journal left behind by an interrupted compaction is ignored on load.
+JOURNAL_SUFFIX = ".journal"
+LOCK_SUFFIX = ".lock"
+COMPACT_EVERY = 1000
+
+# filepath -> {"digest", "entries", "offset", "signature", "data"} describing what
+# the in-memory copy "data" reflects, used to spot writes from other processes.
+# Only that one object is kept current; a write through any other copy of the
+# file (a session still holding the list from before a reload) is first brought
+# level with it.
+_journals = {}
+
+# Parsed files are shared by every session in the process and reused until the
+# file (or its journal) changes on disk. Entries are evicted least-recently-used
+# once the on-disk size of everything cached passes CACHE_MAX_BYTES.
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+_held = threading.local()
+
+# Journal appends are written under the file lock but fsync'd outside it; one
+# fsync covers every append written before it started (group commit).
+_syncs = {}
+_syncs_guard = threading.Lock()
+
+# filepath -> (list object, {record id: position}); positions are checked on use
+# and the map is rebuilt when a delete has shifted them. Only kept for the copy
+# that is cached or tracked, and dropped with it, so eviction frees the list.
+_id_indexes = {}
+
+# Callbacks given each object the cache lets go of, so derived views can drop it too
+_evict_callbacks = []
+
+# filepath -> [writes, appends] applied in memory, so derived views (analytics
+# frames) can tell whether they are current and whether only appends happened
+_versions = {}
+
+# (matches(filepath), decode(record)) pairs for list files whose records are kept
+# as model objects in memory; objects are written back through their to_json()
+_record_types = []
+
+
+class StaleWriteError(Exception):
+    pass
+
+
+def journal_path(filepath):
+    return filepath + JOURNAL_SUFFIX
+
+
+def _digest(raw):
+    return hashlib.sha1(raw).hexdigest()
+
+
+def _encode(value):
+    to_json = getattr(value, "to_json", None)
+    if to_json is None:
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+    return to_json()
+
+
+def _dump(data):
+    return json.dumps(data, indent=4, default=_encode).encode("utf-8")
+
+
+def register_record_type(matches, decode):
+    _record_types.append((matches, decode))
+
+
+def _decoder(filepath):
+    for matches, decode in _record_types:
+        if matches(filepath):
+            return decode
+    return None
+
+
+def _decode_records(filepath, data):
+    decode = _decoder(filepath)
+    if decode is None or not isinstance(data, list):
+        return data
+    return [decode(record) for record in data]
+
+
+def _decode_entry(filepath, entry):
+    decode = _decoder(filepath)
+    if decode is None:
+        return entry
+    if entry["op"] == "batch":
+        return dict(entry, entries=[_decode_entry(filepath, sub_entry) for sub_entry in entry["entries"]])
+    if "record" in entry:
+        return dict(entry, record=decode(entry["record"]))
+    if "records" in entry:
+        return dict(entry, records=[decode(record) for record in entry["records"]])
+    return entry
+
+
+def _write_file(filepath, raw):
+    # Write to a temp file in the same directory and rename it over the target,
+    # so readers and crashes only ever see the old or the new contents
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath) or ".", prefix=os.path.basename(filepath) + ".")
+    count("bytes_written", len(raw))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def file_lock(filepath):
+    # Exclusive lock shared by threads and processes; re-entrant within a thread
+    key = os.path.abspath(filepath)
+    held = getattr(_held, "paths", None)
+    if held is None:
+        held = _held.paths = set()
+    if key in held:
+        yield
+        return
+
+    with _thread_locks_guard:
+        lock = _thread_locks.setdefault(key, threading.Lock())
+    with lock:
+        with open(filepath + LOCK_SUFFIX, "a+b") as f:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        continue
+            held.add(key)
+            try:
+                yield
+            finally:
+                held.discard(key)
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _mark_written(path):
+    with _syncs_guard:
+        sync = _syncs.setdefault(path, {"written": 0, "durable": 0, "running": False, "cond": threading.Condition()})
+    with sync["cond"]:
+        sync["written"] += 1
+        return sync["written"]
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _wait_durable(filepath, seq):
+    # The journal is only opened under the file lock: Windows can't replace or
+    # remove a file another handle has open, which compaction and save_json do
+    path = journal_path(filepath)
+    if os.path.abspath(filepath) in getattr(_held, "paths", ()):
+        # The caller holds the lock around its writes, so a leader could never take it
+        if os.path.exists(path):
+            _fsync(path)
+        return
+    sync = _syncs[path]
+    cond = sync["cond"]
+    with cond:
+        while sync["durable"] < seq:
+            if sync["running"]:
+                cond.wait()
+                continue
+            sync["running"] = True
+            cond.release()
+            synced = False
+            try:
+                with file_lock(filepath):
+                    target = sync["written"]
+                    if os.path.exists(path):
+                        _fsync(path)
+                    # else compacted away meanwhile; the snapshot that replaced it was fsync'd
+                synced = True
+            finally:
+                cond.acquire()
+                sync["running"] = False
+                if synced:
+                    sync["durable"] = max(sync["durable"], target)
+                cond.notify_all()
+
+
+def new_record_id():
+    return uuid.uuid4().hex
+
+
+def _build_index(data):
+    return {record.get("id"): pos for pos, record in enumerate(data)}
+
+
+def _position(data, entry, index):
+    if "index" in entry:
+        return entry["index"]  # written before records had ids
+    record_id = entry["id"]
+    pos = index.get(record_id)
+    if pos is None or pos >= len(data) or data[pos].get("id") != record_id:
+        index.clear()
+        index.update(_build_index(data))
+        pos = index.get(record_id)
+        if pos is None:
+            raise KeyError(record_id)
+    return pos
+
+
+def _apply(data, entry, index=None):
+    op = entry["op"]
+    if index is None and op in ("edit", "delete"):
+        index = {}
+    if op == "add":
+        if index is not None:
+            index[entry["record"].get("id")] = len(data)
+        data.append(entry["record"])
+    elif op == "extend":
+        if index is not None:
+            for pos, record in enumerate(entry["records"], len(data)):
+                index[record.get("id")] = pos
+        data.extend(entry["records"])
+    elif op == "edit":
+        data[_position(data, entry, index)] = entry["record"]
+    elif op == "delete":
+        del data[_position(data, entry, index)]
+        index.pop(entry.get("id"), None)
+    elif op == "set":
+        data[entry["key"]] = entry["value"]
+    elif op == "pop":
+        data.pop(entry["key"], None)
+    elif op == "batch":
+        for sub_entry in entry["entries"]:
+            _apply(data, sub_entry, index)
+
+
+def _replay(filepath, data, digest, offset=0):
+    # Applies journal entries from offset on; returns (entries applied, offset reached)
+    path = journal_path(filepath)
+    if not os.path.exists(path):
+        return 0, 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        lines = f.read().split(b"\n")
+
+    if offset == 0:
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            header = None
+        if not header or header.get("op") != "base" or header.get("digest") != digest:
+            # Journal belongs to an older snapshot (or is unreadable) - it is already folded in
+            os.remove(path)
+            return 0, 0
+        offset = len(lines[0]) + 1
+        lines = lines[1:]
+
+    entries = 0
+    index = {}
+    # The last element is whatever follows the final newline; a torn write ends up there
+    for line in lines[:-1]:
+        try:
+            entry = _decode_entry(filepath, json.loads(line))
+        except ValueError:
+            break
+        _apply(data, entry, index)
+        entries += 1
+        offset += len(line) + 1
+
+    if offset < os.path.getsize(path):
+        with open(path, 'r+b') as f:
+            f.truncate(offset)
+    return entries, offset
+
+
+def _sqlite_target(filepath):
+    if BACKEND != "sqlite":
+        return None
+    table = Database.TABLES.get(os.path.basename(filepath))
+    if table is None:
+        return None
+    return os.path.join(os.path.dirname(filepath), SQLITE_FILE), table
+
+
+def _signature(filepath):
+    target = _sqlite_target(filepath)
+    paths = [target[0], target[0] + "-wal"] if target else [filepath, journal_path(filepath)]
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            signature.append(None)
+            continue
+        signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+def file_signature(filepath):
+    return _signature(filepath)
+
+
+def _signature_bytes(signature):
+    return sum(part[2] for part in signature if part)
+
+
+def _cache_get(filepath):
+    key = os.path.abspath(filepath)
+    signature = _signature(filepath)
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None or entry[0] != signature:
+            return None
+        _cache.move_to_end(key)
+        return entry[1]
+
+
+def on_evict(callback):
+    _evict_callbacks.append(callback)
+
+
+def _forget(data):
+    # Drops every reference the module holds to an object the cache has let go of
+    for filepath, cached in list(_id_indexes.items()):
+        if cached[0] is data:
+            _id_indexes.pop(filepath, None)
+    for state in list(_journals.values()):
+        if state.get("data") is data:
+            state["data"] = None
+    for callback in _evict_callbacks:
+        callback(data)
+
+
+def _cached_object(filepath):
+    entry = _cache.get(os.path.abspath(filepath))
+    return entry[1] if entry is not None else None
+
+
+def _cache_put(filepath, data):
+    global _cache_bytes
+    key = os.path.abspath(filepath)
+    signature = _signature(filepath)
+    size = _signature_bytes(signature)
+    released = []
+    with _cache_lock:
+        old = _cache.pop(key, None)
+        if old is not None:
+            _cache_bytes -= _signature_bytes(old[0])
+            if old[1] is not data:
+                released.append(old[1])
+        if size <= CACHE_MAX_BYTES:
+            _cache[key] = (signature, data)
+            _cache_bytes += size
+            while _cache_bytes > CACHE_MAX_BYTES:
+                _, (old_signature, old_data) = _cache.popitem(last=False)
+                _cache_bytes -= _signature_bytes(old_signature)
+                released.append(old_data)
+    for old_data in released:
+        _forget(old_data)
+
+
+def clear_cache():
+    global _cache_bytes
+    with _cache_lock:
+        released = [data for _, data in _cache.values()]
+        _cache.clear()
+        _cache_bytes = 0
+    for data in released:
+        _forget(data)
+
+
+def is_loaded(filepath):
+    # True while this process holds a copy of the file in memory
+    state = _journals.get(filepath)
+    return _cached_object(filepath) is not None or (state is not None and state.get("data") is not None)
+
+
+def reset():
+    # Forgets every file this process has loaded, as if it had just started
+    clear_cache()
+    _journals.clear()
+    _id_indexes.clear()
+
+
+@timed()
 def load_json(filepath, default={}):
+    data = _cache_get(filepath)
+    if data is not None:
+        return data
+
+    target = _sqlite_target(filepath)
+    if target:
+        with Database.reading(target[0]) as conn:
+            data = _decode_records(filepath, Database.read(conn, target[1]))
+            _journals[filepath] = {"version": Database.version(conn, target[1]), "data": data}
+    elif not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+        return load_json_file(filepath, default)
+    else:
+        data = load_json_file(filepath, default)
+    _cache_put(filepath, data)
+    return data
+
+
+def load_json_file(filepath, default={}):
     if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
         with open(filepath, 'w') as f:
             json.dump(default, f)
         return default
-    with open(filepath, 'r') as f:
-        return json.load(f)
+    with file_lock(filepath):
+        data, digest, entries, offset = _read(filepath)
+        _journals[filepath] = {"digest": digest, "entries": entries, "offset": offset,
+                               "signature": _signature(filepath), "data": data}
+    return data
+
+
+def _read(filepath):
+    # Snapshot plus journal; caller holds the file lock
+    with open(filepath, 'rb') as f:
+        raw = f.read()
+    count("bytes_read", len(raw))
+    data = _decode_records(filepath, json.loads(raw))
+    digest = _digest(raw)
+    entries, offset = _replay(filepath, data, digest)
+    return data, digest, entries, offset
+
+
+def read_json(filepath, default={}):
+    # A private, current copy of the file that is neither cached nor tracked, for
+    # one-off passes over data (backups) that shouldn't stay in memory afterwards
+    target = _sqlite_target(filepath)
+    if target:
+        return _decode_records(filepath, Database.load(*target))
+    if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+        return default
+    with file_lock(filepath):
+        return _read(filepath)[0]
+
+
+def _replace_contents(data, fresh):
+    if isinstance(data, list):
+        data[:] = fresh
+    else:
+        data.clear()
+        data.update(fresh)
+
+
+def _catch_up(filepath, data):
+    # Brings data up to date with writes made by other processes (and through
+    # other copies of the file in this one) since it was loaded, and makes it the
+    # tracked copy. Returns True if anything had changed. Caller holds the file lock.
+    state = _journals.get(filepath)
+    current = state.get("data") if state is not None else None
+    if current is None:
+        # No copy of the file is tracked here, so disk is taken as the truth
+        if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+            _replace_contents(data, load_json_file(filepath))
+            _journals[filepath]["data"] = data
+            _bump(filepath)
+            return True
+        save_json(filepath, data)
+        return False
+
+    changed = False
+    signature = _signature(filepath)
+    if signature != state["signature"]:
+        changed = True
+        file_sig, journal_sig = signature
+        old_file_sig, old_journal_sig = state["signature"]
+        same_journal = old_journal_sig is None or (journal_sig is not None and journal_sig[0] == old_journal_sig[0])
+        if file_sig == old_file_sig and same_journal and journal_sig is not None and journal_sig[2] >= state["offset"]:
+            # Only new journal lines - apply just the tail
+            entries, offset = _replay(filepath, current, state["digest"], state["offset"])
+            state["entries"] += entries
+            state["offset"] = offset
+            state["signature"] = _signature(filepath)
+        else:
+            # Snapshot was rewritten or compacted elsewhere - reload it
+            _replace_contents(current, load_json_file(filepath))
+            _journals[filepath]["data"] = current
+    if current is not data:
+        # data is an older copy (a reload has swapped a fresh one in since); the
+        # write goes through data, so it takes over as the tracked copy
+        _replace_contents(data, current)
+        _journals[filepath]["data"] = data
+        changed = True
+    if changed:
+        _bump(filepath)
+    return changed
+
+
+def _sqlite_catch_up(filepath, data, conn, table):
+    # The SQLite counterpart of _catch_up: reloads data if the table has been written
+    # since this copy was read. Caller holds a transaction on conn.
+    version = Database.version(conn, table)
+    state = _journals.get(filepath)
+    current = state.get("data") if state is not None and state["version"] == version else None
+    if current is data:
+        return False
+    _replace_contents(data, current if current is not None else _decode_records(filepath, Database.read(conn, table)))
+    _journals[filepath] = {"version": version, "data": data}
+    _bump(filepath)
+    return True
+
 
+@timed()
 def save_json(filepath, data):
-    with open(filepath, 'w') as f:
-        json.dump(data, f, indent=4)
+    target = _sqlite_target(filepath)
+    if target:
+        with Database.writing(target[0]) as conn:
+            state = _journals.get(filepath)
+            if state is not None and state["version"] != Database.version(conn, target[1]):
+                raise StaleWriteError(f"{filepath} was changed by another session; reload and try again")
+            Database.replace(conn, target[1], data)
+            version = Database.version(conn, target[1])
+        _journals[filepath] = {"version": version, "data": data}
+        _bump(filepath)
+        _cache_put(filepath, data)
+        return
+
+    with file_lock(filepath):
+        state = _journals.get(filepath)
+        # A file that has since been removed (a discarded staging copy) has nothing to protect
+        if state is not None and os.path.exists(filepath) and _signature(filepath) != state["signature"]:
+            raise StaleWriteError(f"{filepath} was changed by another session; reload and try again")
+        raw = _dump(data)
+        _write_file(filepath, raw)
+        if os.path.exists(journal_path(filepath)):
+            os.remove(journal_path(filepath))
+        _journals[filepath] = {"digest": _digest(raw), "entries": 0, "offset": 0, "signature": _signature(filepath),
+                               "data": data}
+        _bump(filepath)
+        _cache_put(filepath, data)
+
+
+def compact(filepath, data):
+    with file_lock(filepath):
+        raw = _dump(data)
+        digest = _digest(raw)
+        header = (json.dumps({"op": "base", "digest": digest}) + "\n").encode("utf-8")
+        _write_file(filepath, raw)
+        _write_file(journal_path(filepath), header)
+        _journals[filepath] = {"digest": digest, "entries": 0, "offset": len(header),
+                               "signature": _signature(filepath), "data": data}
+
+
+def _append(filepath, entry):
+    # Caller holds the file lock and has caught up; returns the group-commit sequence number.
+    # A failed write is cut back off the journal so the next line doesn't follow a torn one.
+    state = _journals[filepath]
+    path = journal_path(filepath)
+    if not os.path.exists(path):
+        header = (json.dumps({"op": "base", "digest": state["digest"]}) + "\n").encode("utf-8")
+        _write_file(path, header)
+        state["entries"] = 0
+        state["offset"] = len(header)
+
+    line = (json.dumps(entry, default=_encode) + "\n").encode("utf-8")
+    count("bytes_written", len(line))
+    try:
+        with open(path, 'ab') as f:
+            f.write(line)
+    except BaseException:
+        if os.path.exists(path) and os.path.getsize(path) > state["offset"]:
+            with open(path, 'r+b') as f:
+                f.truncate(state["offset"])
+        raise
+    state["entries"] += 1
+    state["offset"] += len(line)
+    state["signature"] = _signature(filepath)
+    return _mark_written(path)
+
+
+def _changes(entry):
+    # (records changed, records appended) by one journal entry
+    if entry["op"] == "batch":
+        counts = [_changes(sub_entry) for sub_entry in entry["entries"]]
+        return sum(c[0] for c in counts), sum(c[1] for c in counts)
+    if entry["op"] == "extend":
+        return len(entry["records"]), len(entry["records"])
+    return 1, int(entry["op"] == "add")
+
+
+def _bump(filepath, entry=None):
+    version = _versions.setdefault(filepath, [0, 0])
+    writes, appends = _changes(entry) if entry is not None else (1, 0)
+    version[0] += writes
+    version[1] += appends
+
+
+def data_version(filepath):
+    return tuple(_versions.get(filepath, (0, 0)))
+
+
+def data_versions():
+    return {filepath: tuple(version) for filepath, version in list(_versions.items())}
+
+
+def _write(filepath, data, make_entry):
+    # make_entry runs after data has caught up with other processes and other
+    # copies of the file, so values it derives from data are current
+    target = _sqlite_target(filepath)
+    if target:
+        with Database.writing(target[0]) as conn:
+            _sqlite_catch_up(filepath, data, conn, target[1])
+            entry = make_entry()
+            if entry is None:
+                return
+            entry = _decode_entry(filepath, entry)
+            Database.apply_entry(conn, target[1], entry)
+            version = Database.version(conn, target[1])
+        # Applied once committed, so a failed write leaves data as it was
+        _apply(data, entry, record_index(filepath, data) if isinstance(data, list) else None)
+        _journals[filepath]["version"] = version
+        _bump(filepath, entry)
+        _cache_put(filepath, data)
+        return
+
+    with file_lock(filepath):
+        _catch_up(filepath, data)
+        entry = make_entry()
+        if entry is None:
+            return
+        entry = _decode_entry(filepath, entry)
+        # Journaled before it is applied, so a failed append leaves every session's copy as it was
+        seq = _append(filepath, entry)
+        _apply(data, entry, record_index(filepath, data) if isinstance(data, list) else None)
+        _bump(filepath, entry)
+        if _journals[filepath]["entries"] >= COMPACT_EVERY:
+            compact(filepath, data)
+        _cache_put(filepath, data)
+    _wait_durable(filepath, seq)
+
+
+def append_record(filepath, data, record):
+    record.setdefault("id", new_record_id())
+    _write(filepath, data, lambda: {"op": "add", "record": record})
+
+
+def append_records(filepath, data, records):
+    # Bulk add: the whole batch is one journal line, so it lands all-or-nothing
+    if not records:
+        return
+    for record in records:
+        record.setdefault("id", new_record_id())
+    _write(filepath, data, lambda: {"op": "extend", "records": records})
+
+
+def record_index(filepath, data):
+    cached = _id_indexes.get(filepath)
+    if cached is not None and cached[0] is data:
+        return cached[1]
+    index = _build_index(data)
+    state = _journals.get(filepath)
+    if _cached_object(filepath) is data or (state is not None and state.get("data") is data):
+        _id_indexes[filepath] = (data, index)
+    return index
+
+
+def get_record(filepath, data, record_id):
+    try:
+        return data[_position(data, {"id": record_id}, record_index(filepath, data))]
+    except KeyError:
+        return None
+
+
+def ensure_ids(filepath, data):
+    # One-off migration: gives every record without an id one and rewrites the file
+    index = record_index(filepath, data)
+    if None not in index:
+        return False
+    for record in data:
+        if not record.get("id"):
+            record["id"] = new_record_id()
+    index.clear()
+    index.update(_build_index(data))
+    save_json(filepath, data)
+    return True
+
+
+def _existing(filepath, data, entry):
+    # Ids are stable, so an edit / delete only goes stale if the record itself is gone
+    if get_record(filepath, data, entry["id"]) is None:
+        raise StaleWriteError(f"record {entry['id']} no longer exists in {filepath}")
+    return entry
+
+
+def update_record(filepath, data, record_id, record):
+    entry = {"op": "edit", "id": record_id, "record": dict(record, id=record_id)}
+    _write(filepath, data, lambda: _existing(filepath, data, entry))
+
+
+def delete_record(filepath, data, record_id):
+    entry = {"op": "delete", "id": record_id}
+    _write(filepath, data, lambda: _existing(filepath, data, entry))
+
+
+def write_batch(filepath, data, make_entries):
+    # Several add / edit / delete / set / pop entries committed as one journal line,
+    # so either all of them land or none do. make_entries runs under the lock once
+    # data has caught up, and can raise to abort the whole batch.
+    def make_entry():
+        entries = make_entries()
+        return {"op": "batch", "entries": entries} if entries else None
+
+    _write(filepath, data, make_entry)
+
+
+def set_value(filepath, data, key, value):
+    _write(filepath, data, lambda: {"op": "set", "key": key, "value": value})
+
+
+def pop_value(filepath, data, key):
+    _write(filepath, data, lambda: {"op": "pop", "key": key})
+
+
+def update_value(filepath, data, key, fn):
+    # Read-modify-write of one key under the lock; fn returning None removes the key
+    def make_entry():
+        value = fn(data.get(key))
+        if value is not None:
+            return {"op": "set", "key": key, "value": value}
+        if key in data:
+            return {"op": "pop", "key": key}
+        return None
+
+    _write(filepath, data, make_entry)
+
 
+@timed()
+def find_patients(filepath, patients, start_date, end_date, search=""):
+    # Returns (index, record) pairs in storage order
+    target = _sqlite_target(filepath)
+    if target:
+        with Database.reading(target[0]) as conn:
+            if _sqlite_catch_up(filepath, patients, conn, target[1]):
+                _cache_put(filepath, patients)
+            rows = Database.find_visits(conn, start_date, end_date, search)
+        # Rows are matched by id; seq only places visits saved before records had ids
+        index = record_index(filepath, patients)
+        return [(idx, patients[idx]) for idx in (index[uid] if uid is not None else seq for uid, seq in rows)]
 
+    found = []
+    for idx, p in enumerate(patients):
+        try:
+            patient_date = datetime.datetime.strptime(p['date'], "%Y-%m-%d").date()
+        except:
+            continue  # skip invalid entries
 
+        if start_date <= patient_date <= end_date:
+            if not search or (search.lower() in p["name"].lower()) or (search in p["phone"]):
+                found.append((idx, p))
+    return found
@@ -0,0 +1,66 @@
+import datetime
+import json
+import os
+import random
+import sys
+
+from Utils.Billing import rebuild
+
+FIRST_NAMES = ["Aarav", "Vivaan", "Aditya", "Ishaan", "Rohan", "Arjun", "Kabir", "Ananya", "Diya", "Saanvi",
+               "Priya", "Kavya", "Meera", "Neha", "Pooja", "Ramesh", "Suresh", "Sunita", "Geeta", "Pramod"]
+LAST_NAMES = ["Sharma", "Verma", "Malviya", "Patel", "Gupta", "Singh", "Yadav", "Joshi", "Mishra", "Tiwari"]
+SYMPTOMS = ["Fever", "Cough", "Headache", "Body ache", "Fever and cough", "Stomach pain", "Weakness",
+            "Cold", "Back pain", "Follow-up"]
+TEST_CATALOG = {
+    "Blood": 100, "SGPT": 280, "HB Percent": 200, "CBC": 300, "X-Ray": 500, "Blood Sugar": 200,
+    "Lipid Profile": 650, "Thyroid Profile": 550, "Urine Routine": 150, "Widal": 250,
+}
+CONSULTATION_FEES = [200, 300, 350, 350, 350, 500]
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+
+def generate_patients(count, days=3 * 365, seed=42):
+    # Visits spread evenly backwards from today, oldest first like the real file
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    test_names = list(TEST_CATALOG)
+    for n in range(count):
+        visit_day = today - datetime.timedelta(days=days - 1 - n * days // count)
+        tests = [{"name": name, "value": rng.choice(["", "", "Normal", f"{rng.uniform(1, 200):.1f}"]),
+                  "cost": TEST_CATALOG[name]}
+                 for name in rng.sample(test_names, rng.choice([0, 0, 1, 1, 2, 3]))]
+        fee = rng.choice(CONSULTATION_FEES)
+        yield {
+            "id": f"{rng.getrandbits(128):032x}",
+            "name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            "age": rng.randint(1, 90),
+            "gender": rng.choice(["Male", "Female", "Other"]),
+            "phone": f"{rng.randint(6, 9)}{rng.randint(0, 10 ** 9 - 1):09d}",
+            "symptoms": rng.choice(SYMPTOMS),
+            "tests": tests,
+            "consultation_fee": fee,
+            "total_amount": fee + sum(test["cost"] for test in tests),
+            "date": visit_day.isoformat(),
+            "time": f"{rng.randint(9, 20):02d}:{rng.randint(0, 59):02d}",
+        }
+
+
+def generate(data_dir, count, seed=42):
+    os.makedirs(data_dir, exist_ok=True)
+    patients = list(generate_patients(count, seed=seed))
+    rollup = rebuild(patients)
+    earnings = {key[2:]: bucket["total"] for key, bucket in sorted(rollup.items()) if key.startswith("d:")}
+    for filename, data in (("patients.json", patients), ("earnings.json", earnings), ("tests.json", TEST_CATALOG)):
+        with open(os.path.join(data_dir, filename), "w") as f:
+            json.dump(data, f, indent=4)
+    return patients
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.generate <data_dir> <10k|100k|1m|count>
+    if len(sys.argv) != 3:
+        print("usage: python -m benchmarks.generate <data_dir> <10k|100k|1m|count>")
+        sys.exit(1)
+    size = SIZES.get(sys.argv[2].lower()) or int(sys.argv[2])
+    generate(sys.argv[1], size)
+    print(f"Wrote {size} visit(s) to {sys.argv[1]}")
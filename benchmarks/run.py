@@ -0,0 +1,138 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from Utils import Billing, Partitions, Storage
+from Utils.Export import export_patients_xml
+from benchmarks.generate import SIZES, generate
+
+# python -m benchmarks.run --sizes 10k,100k --out results.json --baseline old_results.json
+# Each scenario reports the best of --repeat runs, in seconds. With --baseline,
+# any scenario slower than baseline * --threshold is listed and the exit code is 1.
+
+
+def _best(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def _cold_load(path):
+    Storage.reset()
+    return Storage.load_json(path, [])
+
+
+def run_size(count, repeat, work_dir):
+    data_dir = os.path.join(work_dir, str(count))
+    generate(data_dir, count)
+    patients_file = os.path.join(data_dir, "patients.json")
+    rollup_file = os.path.join(data_dir, Billing.ROLLUP_FILE)
+    today = datetime.date.today()
+
+    patients = _cold_load(patients_file)
+    rollup = Billing.rebuild(patients)
+    Storage.save_json(rollup_file, rollup)
+
+    results = {}
+    results["load_json_cold"] = _best(lambda: _cold_load(patients_file), repeat)
+    patients = Storage.load_json(patients_file, [])
+    results["load_json_cached"] = _best(lambda: Storage.load_json(patients_file, []), repeat)
+    results["filter_last_7_days"] = _best(
+        lambda: Storage.find_patients(patients_file, patients, today - datetime.timedelta(days=7), today), repeat)
+    results["filter_search_30_days"] = _best(
+        lambda: Storage.find_patients(patients_file, patients, today - datetime.timedelta(days=30), today, "sharma"),
+        repeat)
+    results["filter_search_all_time"] = _best(
+        lambda: Storage.find_patients(patients_file, patients, datetime.date(2000, 1, 1), today, "98"), repeat)
+    results["earnings_rebuild"] = _best(lambda: Billing.rebuild(patients), repeat)
+    results["earnings_range_totals_x1000"] = _best(
+        lambda: [Billing.total_between(rollup_file, rollup, today - datetime.timedelta(days=n % 365), today)
+                 for n in range(1000)], repeat)
+    results["patients_to_xml"] = _best(
+        lambda: export_patients_xml(patients, os.path.join(data_dir, "backup.xml")), repeat)
+    results["save_json_full"] = _best(lambda: Storage.save_json(patients_file, patients), repeat)
+
+    batch = patients[:100]
+
+    def append_batch():
+        for record in batch:
+            Storage.append_record(patients_file, patients, dict(record, id=Storage.new_record_id()))
+
+    results["append_record_x100"] = _best(append_batch, repeat)
+
+    # Same data split into monthly files; runs last since it moves patients.json aside
+    Partitions.migrate(data_dir)
+    month_start = today.replace(day=1)
+
+    def cold_load_month():
+        Storage.reset()
+        return list(Partitions.iter_records(data_dir, month_start, today))
+
+    results["partitioned_load_month_cold"] = _best(cold_load_month, repeat)
+    results["partitioned_filter_last_7_days"] = _best(
+        lambda: Partitions.find_patients(data_dir, today - datetime.timedelta(days=7), today), repeat)
+    return results
+
+
+def compare(current, baseline, threshold):
+    regressions = []
+    for size, scenarios in current["results"].items():
+        for name, seconds in scenarios.items():
+            before = baseline.get("results", {}).get(size, {}).get(name)
+            if before and seconds > before * threshold:
+                regressions.append((size, name, before, seconds))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clinic app performance benchmarks")
+    parser.add_argument("--sizes", default="10k", help="comma separated: 10k, 100k, 1m or a visit count")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--work-dir", default=None, help="where generated data goes (default: a temp dir)")
+    parser.add_argument("--out", default=None, help="results file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--baseline", default=None, help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2, help="slowdown ratio counted as a regression")
+    args = parser.parse_args(argv)
+
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = args.work_dir or tmp
+        for size in args.sizes.split(","):
+            count = SIZES.get(size.strip().lower()) or int(size)
+            report["results"][size.strip()] = scenarios = run_size(count, args.repeat, work_dir)
+            for name, seconds in scenarios.items():
+                print(f"{size.strip():>6}  {name:<30} {seconds * 1000:10.2f} ms")
+
+    out = args.out or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                                   datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for size, name, before, after in regressions:
+            print(f"REGRESSION {size} {name}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
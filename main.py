@@ -3,10 +3,15 @@ import os
 import shutil
 import json
 import datetime
-from Utils.Storage import load_json, save_json
+from Utils.Storage import load_json, save_json, StaleWriteError, new_record_id
 import pandas as pd
 import io
-from Utils.Export import patients_to_xml
+import math
+import tempfile
+import time
+from Utils.Backup import list_backups, prune_backups, read_for_download
+from Utils import Analytics, Billing, Partitions, Patients, Profiling, Records, Scheduler
+from Utils.Import import import_file
 import datetime
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -15,17 +20,48 @@ os.makedirs(BACKUP_DIR, exist_ok=True)
 
 # --------------------------- Setup ---------------------------
 st.set_page_config(page_title="Clinic Management App", layout="wide")
+if "profile_session" not in st.session_state:
+    st.session_state.profile_session = new_record_id()
+Profiling.start_rerun(st.session_state.profile_session)
 
 # File paths
 DATA_DIR = "data"
-PATIENTS_FILE = os.path.join(DATA_DIR, "patients.json")
 EARNINGS_FILE = os.path.join(DATA_DIR, "earnings.json")
 TESTS_FILE = os.path.join(DATA_DIR, "tests.json")
-
-# Load data or create default
-patients = load_json(PATIENTS_FILE, [])
-earnings = load_json(EARNINGS_FILE, {})
-tests = load_json(TESTS_FILE, {})
+ROLLUP_FILE = os.path.join(DATA_DIR, Billing.ROLLUP_FILE)
+INDEX_FILE = os.path.join(DATA_DIR, Patients.INDEX_FILE)
+
+# Load data or create default. Only this month's visits are loaded up front;
+# older months are read when a page asks for a date range that reaches them.
+with Profiling.stage("load data"):
+    tests = load_json(TESTS_FILE, {})
+    Records.use_catalog(tests)
+    Partitions.migrate(DATA_DIR)
+    recent_patients = list(Partitions.iter_records(DATA_DIR, datetime.date.today().replace(day=1), datetime.date.today()))
+    earnings = load_json(EARNINGS_FILE, {})
+    rollup = load_json(ROLLUP_FILE, {})
+    if not rollup and Partitions.has_records(DATA_DIR):
+        rollup = Billing.rebuild(Partitions.iter_records(DATA_DIR))
+        save_json(ROLLUP_FILE, rollup)
+    patient_index = Patients.load_index(DATA_DIR)
+Profiling.gauge("records", len(recent_patients))
+
+# Backups run on a background thread, started once per server process
+Scheduler.start(DATA_DIR, BACKUP_DIR)
+
+# Long lists are shown one page at a time so only the visible rows build widgets
+PAGE_SIZES = [10, 20, 50, 100]
+
+
+def paginate(items, key):
+    col_size, col_page = st.columns(2)
+    page_size = col_size.selectbox("Records per page", PAGE_SIZES, index=1, key=f"{key}_page_size")
+    pages = max(1, math.ceil(len(items) / page_size))
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = pages
+    page_no = col_page.number_input(f"Page (of {pages})", min_value=1, max_value=pages, step=1, key=f"{key}_page")
+    start = (page_no - 1) * page_size
+    return start, items[start:start + page_size]
 
 st.markdown("""
     <h1 style='font-family: "Trebuchet MS", sans-serif; color: #008000;'>
@@ -33,20 +69,44 @@ st.markdown("""
     </h1>
 """, unsafe_allow_html=True)
 # --------------------------- Navigation ---------------------------
-page = st.sidebar.radio("Navigation", ["Add Patient", "View Patients", "Earnings", "Admin Panel", "Backup"])
+page = st.sidebar.radio("Navigation", ["Add Patient", "View Patients", "Earnings", "Analytics", "Admin Panel", "Backup"])
+Profiling.set_page(page)
+Profiling.mark(f"page: {page}")
 
 # --------------------------- Add Patient Page ---------------------------
 if page == "Add Patient":
     st.header("➕ Add Patient Record")
+
+    # Returning patients: pick them from the index to fill in their details
+    def use_patient(key):
+        entry = patient_index[key]
+        st.session_state.patient_name = entry.get("name") or ""
+        st.session_state.patient_age = min(max(Patients.current_age(entry) or 0, 0), 120)
+        if entry.get("gender") in ["Male", "Female", "Other"]:
+            st.session_state.patient_gender = entry["gender"]
+        st.session_state.patient_phone = Patients.phone_key(entry.get("phone"))
+
+    lookup = st.text_input("🔁 Returning patient? Search by name or phone")
+    matches = Patients.suggest(INDEX_FILE, patient_index, lookup)
+    if lookup and not matches:
+        st.caption("No earlier visits found.")
+    elif matches:
+        col_pick, col_use = st.columns([4, 1])
+        chosen = col_pick.selectbox(
+            "Earlier patients", matches,
+            format_func=lambda key: f"{patient_index[key].get('name')} - {patient_index[key].get('phone') or 'no phone'} "
+                                    f"({len(patient_index[key]['visits'])} visit(s), last {patient_index[key]['visits'][-1][0]})")
+        col_use.button("📋 Use details", on_click=use_patient, args=(chosen,))
+
     with st.form("add_patient_form"):
         st.subheader("👤 Patient Information")
         col1, col2 = st.columns(2)
         with col1:
-            patient_name = st.text_input("Patient Name")
-            age = st.number_input("Age", min_value=0, max_value=120, step=1)
+            patient_name = st.text_input("Patient Name", key="patient_name")
+            age = st.number_input("Age", min_value=0, max_value=120, step=1, key="patient_age")
         with col2:
-            gender = st.selectbox("Gender", ["Male", "Female", "Other"])
-            phone = st.text_input("Phone Number", max_chars=10)
+            gender = st.selectbox("Gender", ["Male", "Female", "Other"], key="patient_gender")
+            phone = st.text_input("Phone Number", max_chars=10, key="patient_phone")
 
         phone_valid = phone.isdigit() and len(phone) == 10
         if phone:
@@ -118,6 +178,7 @@ if page == "Add Patient":
                 st.session_state.confirm_add = True
                 now = datetime.datetime.now()
                 st.session_state.pending_patient = {
+                "id": new_record_id(),
                 "name": patient_name,
                 "age": age,
                 "gender": gender,
@@ -142,12 +203,11 @@ if page == "Add Patient" and st.session_state.get("confirm_add", False):
         if not pending or not pending.get("name", "").strip():
             st.error("❌ Patient name is required. Record not saved.")
         else:
-            patients.append(pending)
-            save_json(PATIENTS_FILE, patients)
+            Partitions.append_record(DATA_DIR, pending)
 
-            today = pending["date"]
-            earnings[today] = earnings.get(today, 0) + pending["total_amount"]
-            save_json(EARNINGS_FILE, earnings)
+            Billing.add_visit(ROLLUP_FILE, rollup, pending)
+            Billing.sync_daily(EARNINGS_FILE, earnings, rollup, pending["date"])
+            Patients.add_visit(INDEX_FILE, patient_index, pending)
 
             st.success("✅ Patient record saved.")
             st.session_state.confirm_add = False
@@ -200,15 +260,18 @@ elif page == "Admin Panel":
                 updated = True
                 break
 
-        if to_delete:
-            tests.pop(to_delete)
-            save_json(TESTS_FILE, tests)
-            st.rerun()
+        try:
+            if to_delete:
+                tests.pop(to_delete)
+                save_json(TESTS_FILE, tests)
+                st.rerun()
 
-        if updated:
-            save_json(TESTS_FILE, tests)
-            st.success("✅ Test updated.")
-            st.rerun()
+            if updated:
+                save_json(TESTS_FILE, tests)
+                st.success("✅ Test updated.")
+                st.rerun()
+        except StaleWriteError:
+            st.error("⚠️ The test list was changed at another terminal. Please review it and try again.")
 
         st.divider()
         st.subheader("➕ Add New Test")
@@ -221,13 +284,59 @@ elif page == "Admin Panel":
                 st.warning("Test already exists.")
             else:
                 tests[new_test] = new_price
-                save_json(TESTS_FILE, tests)
-                st.success(f"✅ Test '{new_test}' added.")
-                st.rerun()
+                try:
+                    save_json(TESTS_FILE, tests)
+                except StaleWriteError:
+                    st.error("⚠️ The test list was changed at another terminal. Please try again.")
+                else:
+                    st.success(f"✅ Test '{new_test}' added.")
+                    st.rerun()
         st.divider()
+
+        st.subheader("🩺 Diagnostics")
+        show_reruns = st.number_input("Reruns to show", min_value=1, max_value=Profiling.MAX_RERUNS, value=20)
+        reruns = Profiling.recent_reruns(show_reruns)
+        st.caption(f"{Profiling.rerun_count()} rerun(s) since the server started. Times are in milliseconds.")
+        if reruns:
+            rows = []
+            for r in reruns:
+                row = {"rerun": r["rerun"], "started": r["started"], "page": r["page"], "total": r["total_ms"]}
+                row.update({name: s["ms"] for name, s in r["stages"].items()})
+                row.update(r["counters"])
+                rows.append(row)
+            st.dataframe(pd.DataFrame(rows), hide_index=True, use_container_width=True)
+            st.download_button(
+                label="⬇️ Export Diagnostics (JSON)",
+                data=Profiling.export_json(reruns),
+                file_name="diagnostics.json",
+                mime="application/json"
+            )
 # --------------------------- View Patients Page ---------------------------
 elif page == "View Patients":
     st.header("📋 Patient Records")
+
+    # Whole history of one patient from the index, whatever the date range below
+    st.subheader("🧑 Patient History")
+    history_search = st.text_input("Find a patient by name or phone", key="history_search")
+    history_keys = Patients.suggest(INDEX_FILE, patient_index, history_search)
+    if history_search and not history_keys:
+        st.caption("No patient found.")
+    elif history_keys:
+        chosen = st.selectbox("Patient", history_keys, key="history_patient",
+                              format_func=lambda key: f"{patient_index[key].get('name')} - {patient_index[key].get('phone') or 'no phone'}")
+        entry = patient_index[chosen]
+        visits = Patients.history(DATA_DIR, entry)
+        st.markdown(f"**{entry.get('name')}**, {Patients.current_age(entry)} years, {entry.get('gender') or 'Not specified'}, "
+                    f"📞 {entry.get('phone') or 'no phone'} - {len(visits)} visit(s), "
+                    f"₹{sum(v.get('total_amount', 0) for v in visits)} in total")
+        st.dataframe(pd.DataFrame([{
+            "Date": v["date"],
+            "Time": v.get("time", ""),
+            "Symptoms": v.get("symptoms", ""),
+            "Tests": ", ".join(f"{t['name']}: {t['value']}" if t.get("value") else t["name"] for t in v.get("tests", [])),
+            "Total (₹)": v.get("total_amount", 0),
+        } for v in visits]), hide_index=True, use_container_width=True)
+
         # Date range filter
     st.subheader("📅 Filter by Date Range")
     col1, col2 = st.columns(2)
@@ -237,58 +346,52 @@ elif page == "View Patients":
     if start_date > end_date:
         st.warning("⚠️ Start date must be before or equal to end date.")
 
-    if not patients:
+    if not Partitions.has_records(DATA_DIR):
         st.info("No patient records yet.")
     else:
         search = st.text_input("🔍 Search by name or phone number")
-        filtered = []
-        for p in patients:
-            try:
-                patient_date = datetime.datetime.strptime(p['date'], "%Y-%m-%d").date()
-            except:
-                continue  # skip invalid entries
-
-            if start_date <= patient_date <= end_date:
-                 if not search or (search.lower() in p["name"].lower()) or (search in p["phone"]):
-                    filtered.append(p)
-
+        filtered = Partitions.find_patients(DATA_DIR, start_date, end_date, search)
 
+        Profiling.gauge("filtered", len(filtered))
 
         st.write(f"Showing {len(filtered)} record(s)")
-        for i, p in enumerate(reversed(filtered), 1):  # Newest first
-            try:
-                dt = datetime.datetime.strptime(f"{p['date']} {p.get('time', '00:00')}", "%Y-%m-%d %H:%M")
+        start, page_rows = paginate(filtered[::-1], "view_patients")  # Newest first
+        Profiling.mark("render: View Patients")
+        for i, (_, p) in enumerate(page_rows, start + 1):
+            rid = p["id"]  # widget keys follow the record, not its position in the list
+            dt = p.visit_datetime()  # parsed once when the partition was loaded
+            if dt:
                 formatted_date = dt.strftime("%d-%m-%Y")
                 formatted_time = dt.strftime("%I:%M %p")
-            except:
+            else:
                 formatted_date = p['date']
                 formatted_time = p.get('time', 'Not recorded')
 
             with st.expander(f"{i}. {p['name']} - ₹{p['total_amount']} on {formatted_date} at {formatted_time}"):
-                if st.session_state.get(f"editing_{i}", False):
-                    new_name = st.text_input("Name", value=p['name'], key=f"edit_name_{i}")
-                    new_age = st.number_input("Age", value=p['age'], min_value=0, max_value=120, key=f"edit_age_{i}")
-                    new_phone = st.text_input("Phone", value=p['phone'], key=f"edit_phone_{i}")
-                    new_symptoms = st.text_area("Symptoms", value=p['symptoms'], key=f"edit_symptoms_{i}")
-                    new_gender = st.selectbox("Gender", ["Male", "Female", "Other"], index=["Male", "Female", "Other"].index(p.get("gender", "Other")), key=f"edit_gender_{i}")
+                if st.session_state.get(f"editing_{rid}", False):
+                    new_name = st.text_input("Name", value=p['name'], key=f"edit_name_{rid}")
+                    new_age = st.number_input("Age", value=p['age'], min_value=0, max_value=120, key=f"edit_age_{rid}")
+                    new_phone = st.text_input("Phone", value=p['phone'], key=f"edit_phone_{rid}")
+                    new_symptoms = st.text_area("Symptoms", value=p['symptoms'], key=f"edit_symptoms_{rid}")
+                    new_gender = st.selectbox("Gender", ["Male", "Female", "Other"], index=["Male", "Female", "Other"].index(p.get("gender", "Other")), key=f"edit_gender_{rid}")
                     
                     new_tests = []
                     test_total = 0
                     for j, test in enumerate(p.get("tests", [])):
                         col1, col2, col3 = st.columns([4, 3, 2])
-                        test_name = col1.text_input("Test Name", value=test['name'], key=f"edit_test_name_{i}_{j}")
-                        test_value = col2.text_input("Result", value=test['value'], key=f"edit_test_val_{i}_{j}")
-                        test_cost = col3.number_input("₹", value=test['cost'], min_value=0, key=f"edit_test_cost_{i}_{j}")
+                        test_name = col1.text_input("Test Name", value=test['name'], key=f"edit_test_name_{rid}_{j}")
+                        test_value = col2.text_input("Result", value=test['value'], key=f"edit_test_val_{rid}_{j}")
+                        test_cost = col3.number_input("₹", value=test['cost'], min_value=0, key=f"edit_test_cost_{rid}_{j}")
                         new_tests.append({"name": test_name, "value": test_value, "cost": test_cost})
                         test_total += test_cost
 
-                    new_fee = st.number_input("Consultation Fee", value=p["consultation_fee"], min_value=0, key=f"edit_fee_{i}")
+                    new_fee = st.number_input("Consultation Fee", value=p["consultation_fee"], min_value=0, key=f"edit_fee_{rid}")
                     new_total = test_total + new_fee
                     st.markdown(f"### 💰 Updated Total: ₹{new_total}")
 
                     col_save, col_cancel = st.columns(2)
-                    if col_save.button("💾 Save Changes", key=f"save_{i}"):
-                        p.update({
+                    if col_save.button("💾 Save Changes", key=f"save_{rid}"):
+                        updated_record = dict(p, **{
                             "name": new_name,
                             "age": new_age,
                             "phone": new_phone,
@@ -298,17 +401,21 @@ elif page == "View Patients":
                             "consultation_fee": new_fee,
                             "total_amount": new_total
                         })
-
-                        earnings[p["date"]] = sum(pat["total_amount"] for pat in patients if pat["date"] == p["date"])
-                        save_json(PATIENTS_FILE, patients)
-                        save_json(EARNINGS_FILE, earnings)
-
-                        st.success("✅ Patient record updated.")
-                        st.session_state[f"editing_{i}"] = False
-                        st.rerun()
-
-                    if col_cancel.button("❌ Cancel", key=f"cancel_{i}"):
-                        st.session_state[f"editing_{i}"] = False
+                        try:
+                            Partitions.update_record(DATA_DIR, rid, updated_record)
+                        except StaleWriteError:
+                            st.error("⚠️ This record was deleted at another terminal.")
+                        else:
+                            Billing.edit_visit(ROLLUP_FILE, rollup, p, updated_record)
+                            Billing.sync_daily(EARNINGS_FILE, earnings, rollup, p["date"])
+                            Patients.edit_visit(INDEX_FILE, patient_index, p, updated_record)
+
+                            st.success("✅ Patient record updated.")
+                            st.session_state[f"editing_{rid}"] = False
+                            st.rerun()
+
+                    if col_cancel.button("❌ Cancel", key=f"cancel_{rid}"):
+                        st.session_state[f"editing_{rid}"] = False
                         st.rerun()
 
                 else:
@@ -331,20 +438,21 @@ elif page == "View Patients":
                     st.markdown(f"**Total Paid:** ₹{p['total_amount']}")
 
                     col_edit, col_delete = st.columns(2)
-                    if col_edit.button("✏️ Edit Record", key=f"edit_{i}"):
-                        st.session_state[f"editing_{i}"] = True
+                    if col_edit.button("✏️ Edit Record", key=f"edit_{rid}"):
+                        st.session_state[f"editing_{rid}"] = True
                         st.rerun()
 
-                    if col_delete.button("🗑️ Delete Record", key=f"delete_{i}"):
-                        patients.remove(p)
-                        if p["date"] in earnings:
-                            earnings[p["date"]] -= p["total_amount"]
-                            if earnings[p["date"]] <= 0:
-                                earnings.pop(p["date"])
-                        save_json(PATIENTS_FILE, patients)
-                        save_json(EARNINGS_FILE, earnings)
-                        st.success("Record deleted.")
-                        st.rerun()
+                    if col_delete.button("🗑️ Delete Record", key=f"delete_{rid}"):
+                        try:
+                            Partitions.delete_record(DATA_DIR, p)
+                        except StaleWriteError:
+                            st.error("⚠️ This record was already deleted at another terminal.")
+                        else:
+                            Billing.remove_visit(ROLLUP_FILE, rollup, p)
+                            Billing.sync_daily(EARNINGS_FILE, earnings, rollup, p["date"])
+                            Patients.remove_visit(INDEX_FILE, patient_index, p)
+                            st.success("Record deleted.")
+                            st.rerun()
 
 
 
@@ -375,73 +483,208 @@ elif page == "Earnings":
             st.info("No earnings data available yet.")
         else:
             today = datetime.date.today()
-            today_str = str(today)
-            past_7 = [(today - datetime.timedelta(days=i)).isoformat() for i in range(7)]
-            this_month = today.strftime("%Y-%m")
+            this_month = Billing.month(rollup, today.strftime("%Y-%m"))
 
-            total_today = earnings.get(today_str, 0)
-            total_week = sum(earnings.get(date, 0) for date in past_7)
-            total_month = sum(amount for date, amount in earnings.items() if date.startswith(this_month))
+            total_today = Billing.day(rollup, today.isoformat())["total"]
+            total_week = Billing.total_between(ROLLUP_FILE, rollup, today - datetime.timedelta(days=6), today)
+            total_month = this_month["total"]
 
             st.metric("🗓️ Today's Earnings", f"₹{total_today}")
             st.metric("📅 Last 7 Days", f"₹{total_week}")
             st.metric("📆 This Month", f"₹{total_month}")
+            st.caption(f"This month: ₹{this_month['consultation']} consultations, ₹{this_month['tests']} tests, {this_month['visits']} visit(s)")
+
+            st.divider()
+            st.subheader("🔎 Earnings for a Date Range")
+            col1, col2 = st.columns(2)
+            range_start = col1.date_input("From", value=today.replace(day=1), key="earnings_from")
+            range_end = col2.date_input("To", value=today, key="earnings_to")
+            summary = Billing.breakdown_between(ROLLUP_FILE, rollup, range_start, range_end)
+            col1, col2, col3 = st.columns(3)
+            col1.metric("💰 Total", f"₹{summary['total']}")
+            col2.metric("🩺 Consultations", f"₹{summary['consultation']}")
+            col3.metric("🧪 Tests", f"₹{summary['tests']}")
+            if summary["by_test"]:
+                st.markdown("**🧪 Revenue by Test:**")
+                for name, amount in sorted(summary["by_test"].items(), key=lambda item: -item[1]):
+                    st.markdown(f"- {name}: ₹{amount}")
 
             st.divider()
             st.subheader("📊 Click a Date to View Patients")
 
-            # Group patients by date
-            grouped = {}
-            for p in patients:
-                grouped.setdefault(p["date"], []).append(p)
-
-            for date in sorted(grouped.keys(), reverse=True):
-                with st.expander(f"📅 {date} — ₹{earnings.get(date, 0)}"):
-                    for idx, patient in enumerate(grouped[date], 1):
-                        with st.expander(f"{idx}. {patient['name']} — ₹{patient['total_amount']}"):
-                            st.markdown(f"**🧍 Name:** {patient['name']}")
-                            st.markdown(f"**📞 Phone:** {patient['phone']}")
-                            st.markdown(f"**👤 Age:** {patient['age']} years")
-                            st.markdown(f"**🤒 Symptoms:** {patient['symptoms']}")
-
-                            if patient['tests']:
-                                st.markdown("**🧪 Tests:**")
-                                for test in patient['tests']:
-                                    st.markdown(f"- {test['name']}: {test['value']} (₹{test['cost']})")
-                            else:
-                                st.markdown("No tests recorded.")
-
-                            st.markdown(f"**💵 Consultation Fee:** ₹{patient['consultation_fee']}")
-                            st.markdown(f"**💰 Total Paid:** ₹{patient['total_amount']}")
-                            st.markdown(f"**📅 Date:** {patient['date']}")
+            # Patients for a date are only looked up once that date is opened
+            open_dates = st.session_state.setdefault("open_dates", set())
+            _, page_dates = paginate(sorted(earnings, reverse=True), "earnings_dates")
+            Profiling.mark("render: Earnings dates")
+
+            for date in page_dates:
+                marker = "▼" if date in open_dates else "▶"
+                if st.button(f"{marker} 📅 {date} — ₹{earnings.get(date, 0)}", key=f"date_{date}"):
+                    open_dates.symmetric_difference_update({date})
+                    st.rerun()
+                if date not in open_dates:
+                    continue
+
+                try:
+                    day = datetime.date.fromisoformat(date)
+                except ValueError:
+                    continue
+                for idx, (_, patient) in enumerate(Partitions.find_patients(DATA_DIR, day, day), 1):
+                    with st.expander(f"{idx}. {patient['name']} — ₹{patient['total_amount']}"):
+                        st.markdown(f"**🧍 Name:** {patient['name']}")
+                        st.markdown(f"**📞 Phone:** {patient['phone']}")
+                        st.markdown(f"**👤 Age:** {patient['age']} years")
+                        st.markdown(f"**🤒 Symptoms:** {patient['symptoms']}")
+
+                        if patient['tests']:
+                            st.markdown("**🧪 Tests:**")
+                            for test in patient['tests']:
+                                st.markdown(f"- {test['name']}: {test['value']} (₹{test['cost']})")
+                        else:
+                            st.markdown("No tests recorded.")
+
+                        st.markdown(f"**💵 Consultation Fee:** ₹{patient['consultation_fee']}")
+                        st.markdown(f"**💰 Total Paid:** ₹{patient['total_amount']}")
+                        st.markdown(f"**📅 Date:** {patient['date']}")
+
+# --------------------------- Analytics Page ---------------------------
+elif page == "Analytics":
+    st.header("📈 Visit Analytics")
+
+    if not st.session_state.get("earnings_authenticated", False):
+        st.info("🔒 Unlock the Earnings page to view analytics.")
+    elif not Partitions.has_records(DATA_DIR):
+        st.info("No visits recorded yet.")
+    else:
+        today = datetime.date.today()
+        col1, col2 = st.columns(2)
+        range_start = col1.date_input("From", value=today - datetime.timedelta(days=90), key="analytics_from")
+        range_end = col2.date_input("To", value=today, key="analytics_to")
+        visits_df, tests_df = Analytics.range_frames(DATA_DIR, range_start, range_end)
+        Profiling.mark("render: Analytics")
+
+        stats = Analytics.averages(visits_df, tests_df)
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("🧍 Visits", stats["visits"])
+        col2.metric("💰 Avg per Visit", f"₹{stats['avg_total']:.0f}")
+        col3.metric("🩺 Avg Consultation", f"₹{stats['avg_consultation']:.0f}")
+        col4.metric("🧪 Avg Tests per Visit", f"{stats['avg_tests']:.2f}")
+
+        st.subheader("📅 Visits per Day")
+        st.line_chart(Analytics.visits_per_day(visits_df)["visits"])
+
+        st.subheader("🗓️ Visits and Revenue per Week")
+        st.dataframe(Analytics.visits_per_week(visits_df), use_container_width=True)
+
+        st.subheader("🧪 Revenue per Test")
+        per_test = Analytics.revenue_per_test(tests_df)
+        if per_test.empty:
+            st.info("No tests in this range.")
+        else:
+            st.bar_chart(per_test["revenue"])
+            st.dataframe(per_test, use_container_width=True)
+
+        st.subheader("👥 Age and Gender")
+        st.dataframe(Analytics.age_gender_breakdown(visits_df), use_container_width=True)
 
 # --------------------------- Backup Page ---------------------------
 elif page == "Backup":
-    st.header("📦 Manual XML Backup")
+    st.header("📦 XML Backup")
 
-    today_str = datetime.date.today().strftime("%Y-%m-%d")
-    backup_filename = f"patients_backup_{today_str}.xml"
-    backup_path = os.path.join(BACKUP_DIR, backup_filename)
+    schedule = Scheduler.settings(DATA_DIR)
+    keep_days = schedule["keep_days"]
+    keep_min = schedule["keep_min"]
 
-    if st.button("🧾 Backup Patient Records Now"):
-        try:
-            pretty_xml = patients_to_xml(patients)
-            with open(backup_path, "w", encoding="utf-8") as f:
-                f.write(pretty_xml)
-            st.success(f"✅ Backup saved as `{backup_filename}`")
-        except Exception as e:
-            st.error(f"❌ Backup failed: {e}")
+    # Backups are written by the scheduler thread; this page only queues them and shows progress
+    backup_status = Scheduler.status()
+    col1, col2 = st.columns(2)
+    col1.metric("🕒 Last Backup", backup_status["last_run"] or "Never")
+    col2.metric("⏭️ Next Scheduled", backup_status["next_run"] or "Off")
+    if schedule["after_writes"]:
+        st.caption(f"Also runs after {schedule['after_writes']} record changes "
+                   f"({backup_status['writes_since']} since the last backup).")
+    if backup_status["last_file"]:
+        st.caption(f"Last file written: `{backup_status['last_file']}` ({backup_status['trigger']})")
+    if backup_status["state"] == "failed":
+        st.error(f"❌ Last backup failed: {backup_status['last_error']}")
+
+    compress_backup = st.checkbox("🗜️ Compress backup (.xml.gz)")
+    col1, col2 = st.columns(2)
+    full_pressed = col1.button("🧾 Backup Patient Records Now")
+    incremental_pressed = col2.button("➕ Incremental Backup (changes only)")
+
+    if full_pressed or incremental_pressed:
+        if Scheduler.request_backup(full=full_pressed, compress=compress_backup):
+            st.rerun()
+        st.info("A backup is already in progress.")
+
+    # While a backup runs the page reruns every second (at the end of the page) to move the bar
+    backup_busy = backup_status["state"] in ("queued", "running")
+    if backup_busy:
+        total = backup_status["total"]
+        st.progress(backup_status["done"] / total if total else 0.0,
+                    text=f"⏳ Backing up… {100 * backup_status['done'] // total}%" if total else "⏳ Starting backup…")
 
     st.markdown("### 📁 Existing XML Backups:")
 
-    backup_files = sorted(os.listdir(BACKUP_DIR), reverse=True)
-    for file in backup_files:
-        if file.endswith(".xml"):
-            file_path = os.path.join(BACKUP_DIR, file)
-            with open(file_path, "rb") as f:
-                st.download_button(
-                    label=f"⬇️ Download {file}",
-                    data=f.read(),
-                    file_name=file,
-                    mime="application/xml"
-                )
+    # Only metadata is listed; a file is read once the user asks to download it
+    backups = list_backups(BACKUP_DIR)
+    if not backups:
+        st.info("No backups yet.")
+    else:
+        st.dataframe(pd.DataFrame(backups), hide_index=True, use_container_width=True)
+
+        col1, col2 = st.columns([3, 1])
+        chosen = col1.selectbox("Backup file", [b["file"] for b in backups])
+        compress_download = col2.checkbox("🗜️ Download as .gz")
+        if st.button("📥 Prepare Download"):
+            st.session_state.download_backup = (chosen, compress_download)
+
+        if st.session_state.get("download_backup") == (chosen, compress_download) and backup_busy:
+            st.info("⏳ The download will be prepared once the backup has finished.")
+        elif st.session_state.get("download_backup") == (chosen, compress_download):
+            data, download_name = read_for_download(BACKUP_DIR, chosen, compress_download)
+            st.download_button(
+                label=f"⬇️ Download {download_name}",
+                data=data,
+                file_name=download_name,
+                mime="application/gzip" if download_name.endswith(".gz") else "application/xml"
+            )
+
+    st.caption(f"Backups older than {keep_days} days are pruned after each backup (the newest {keep_min} and the current backup chain are always kept).")
+    if st.button("🧹 Prune Old Backups Now"):
+        removed = prune_backups(BACKUP_DIR, keep_days, keep_min)
+        st.success(f"✅ Removed {len(removed)} old backup(s).")
+        st.rerun()
+
+    st.divider()
+    st.markdown("### 📤 Import / Restore Records")
+    if not st.session_state.get("authenticated", False):
+        st.info("🔒 Log in on the Admin Panel to import records.")
+    else:
+        upload = st.file_uploader("XML backup, JSON or CSV file", type=["xml", "gz", "json", "jsonl", "csv"])
+        replace_existing = st.checkbox("♻️ Replace all existing records (restore)")
+        if upload is not None and st.button("📤 Import Records"):
+            # Streamed from a temp file so large uploads are parsed record by record
+            suffix = ".xml.gz" if upload.name.endswith(".gz") else os.path.splitext(upload.name)[1]
+            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+                shutil.copyfileobj(upload, tmp, 1024 * 1024)
+            try:
+                report = import_file(tmp.name, DATA_DIR, replace=replace_existing)
+            except Exception as e:
+                st.error(f"❌ Import failed: {e}")
+            else:
+                st.success(f"✅ Imported {report['imported']} record(s); earnings rebuilt.")
+                if report["rejected"]:
+                    st.warning(f"⚠️ {len(report['rejected'])} record(s) were rejected.")
+                    st.dataframe(pd.DataFrame([{"row": row, "problems": "; ".join(problems)}
+                                               for row, _, problems in report["rejected"]]),
+                                 hide_index=True, use_container_width=True)
+            finally:
+                os.remove(tmp.name)
+
+    if backup_busy:
+        time.sleep(1)
+        st.rerun()
+
+Profiling.finish_rerun()
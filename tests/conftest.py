@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Utils import Storage  # noqa: E402
+
+CATALOG = {"CBC": 300, "SGPT": 200}
+
+
+def restart():
+    # Forget everything this process knows, as if the app had been restarted
+    Storage.reset()
+
+
+def visit(record_id, date, phone="", fee=100, tests=()):
+    # A visit as the Add Patient form saves it; tests is [(name, cost)]
+    tests = [{"name": name, "value": "", "cost": cost} for name, cost in tests]
+    return {"id": record_id, "name": f"Patient {record_id}", "age": 30, "gender": "Male", "phone": phone,
+            "symptoms": "", "tests": tests, "consultation_fee": fee,
+            "total_amount": fee + sum(test["cost"] for test in tests), "date": date, "time": "10:00"}
+
+
+@pytest.fixture(autouse=True)
+def fresh_storage():
+    restart()
+    yield
+    restart()
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    # An empty data directory with the test catalog
+    data_dir = str(tmp_path / "data")
+    os.makedirs(data_dir)
+    Storage.save_json(os.path.join(data_dir, "tests.json"), dict(CATALOG))
+    return data_dir
@@ -0,0 +1,55 @@
+import pytest
+
+from Utils import Analytics, Partitions
+
+from conftest import restart, visit as make_visit
+
+
+def visit(record_id, date, total=100):
+    return make_visit(record_id, date, fee=total - 50, tests=[("CBC", 50)])
+
+
+@pytest.fixture(autouse=True)
+def no_frames():
+    Analytics._frames.clear()
+    yield
+    Analytics._frames.clear()
+
+
+def test_frames_follow_appends_and_edits(data_dir):
+    Partitions.append_records(data_dir, [visit("1", "2026-10-01"), visit("2", "2026-10-02")])
+    filepath = Partitions.file_for(data_dir, "2026-10-01")
+    visits, tests = Analytics.visit_frames(filepath)
+    assert list(visits["id"]) == ["1", "2"] and len(tests) == 2
+
+    Partitions.append_record(data_dir, visit("3", "2026-10-03"))
+    visits, _ = Analytics.visit_frames(filepath)
+    assert list(visits["id"]) == ["1", "2", "3"]
+
+    Partitions.update_record(data_dir, "2", visit("2", "2026-10-02", total=500))
+    visits, _ = Analytics.visit_frames(filepath)
+    assert list(visits["total_amount"]) == [100, 500, 100]
+
+
+def test_current_frames_skip_the_json_parse(data_dir, monkeypatch):
+    Partitions.append_records(data_dir, [visit("1", "2026-10-01")])
+    filepath = Partitions.file_for(data_dir, "2026-10-01")
+    Analytics.visit_frames(filepath)
+
+    monkeypatch.setattr(Partitions, "load_partition", lambda filepath: pytest.fail("partition was parsed"))
+    visits, _ = Analytics.visit_frames(filepath)
+    assert list(visits["id"]) == ["1"]
+
+
+def test_snapshot_is_used_after_a_restart(data_dir, monkeypatch):
+    pytest.importorskip("pyarrow")
+    Partitions.append_records(data_dir, [visit("1", "2026-10-01")])
+    filepath = Partitions.file_for(data_dir, "2026-10-01")
+    visits, tests = Analytics.visit_frames(filepath)
+    Analytics.save_snapshot(filepath, visits, tests)
+
+    restart()
+    Analytics._frames.clear()
+    monkeypatch.setattr(Partitions, "load_partition", lambda filepath: pytest.fail("partition was parsed"))
+    visits, _ = Analytics.visit_frames(filepath)
+    assert list(visits["id"]) == ["1"]
@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from Utils import Backup
+
+from conftest import visit
+
+
+@pytest.fixture
+def backup_dir(tmp_path):
+    backup_dir = str(tmp_path / "backup")
+    os.makedirs(backup_dir)
+    return backup_dir
+
+
+def by_id(patients):
+    return sorted(patients, key=lambda patient: patient["id"])
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_chain_restores_adds_edits_and_deletes(backup_dir, compress):
+    patients = [visit(str(i), "2026-10-01", tests=[("CBC", 300)]) for i in range(1, 6)]
+    base = Backup.run_backup(patients, backup_dir, compress=compress)
+    assert base.endswith(".xml.gz" if compress else ".xml")
+
+    patients.append(visit("6", "2026-10-02"))
+    assert Backup.run_backup(patients, backup_dir, compress=compress).startswith("patients_delta_")
+    patients[0] = dict(patients[0], name="Renamed")
+    del patients[2]
+    Backup.run_backup(patients, backup_dir, compress=compress)
+
+    manifest = Backup.load_manifest(backup_dir)
+    assert manifest["base"] == base and len(manifest["deltas"]) == 2
+    assert by_id(Backup.restore(backup_dir)) == by_id(patients)
+    assert Backup.run_backup(patients, backup_dir, compress=compress) is None
+
+
+def test_backups_in_the_same_instant_get_their_own_files(backup_dir, monkeypatch):
+    monkeypatch.setattr(Backup, "_stamp", lambda: "2026-10-17_100000_000000")
+    patients = [visit("1", "2026-10-01")]
+    Backup.run_backup(patients, backup_dir)
+    patients.append(visit("2", "2026-10-01"))
+    first = Backup.run_backup(patients, backup_dir)
+    patients.append(visit("3", "2026-10-01"))
+    second = Backup.run_backup(patients, backup_dir)
+
+    assert first != second
+    assert Backup.load_manifest(backup_dir)["deltas"] == [first, second]
+    assert by_id(Backup.restore(backup_dir)) == by_id(patients)
+
+
+def test_failed_full_backup_keeps_the_chain(backup_dir, monkeypatch):
+    patients = [visit(str(i), "2026-10-01") for i in range(1, 4)]
+    Backup.run_backup(patients, backup_dir)
+    before = sorted(os.listdir(backup_dir))
+
+    def fail(patients, f, progress=None):
+        f.write(Backup.XML_HEADER + "<Patients>\n")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(Backup, "write_patients_xml", fail)
+    with pytest.raises(OSError):
+        Backup.run_backup(patients + [visit("4", "2026-10-02")], backup_dir, full=True)
+
+    assert sorted(os.listdir(backup_dir)) == before
+    assert by_id(Backup.restore(backup_dir)) == by_id(patients)
@@ -0,0 +1,33 @@
+import os
+
+from Utils import Billing
+from Utils.Storage import journal_path, load_json, save_json
+
+from conftest import restart, visit
+
+
+def test_visit_changes_match_a_rebuild(tmp_path):
+    path = str(tmp_path / Billing.ROLLUP_FILE)
+    save_json(path, {})
+    rollup = load_json(path, {})
+    first, second = visit("1", "2026-10-16", tests=[("CBC", 300)]), visit("2", "2026-10-17", fee=200)
+    Billing.add_visit(path, rollup, first)
+    Billing.add_visit(path, rollup, second)
+    edited = dict(second, consultation_fee=250, total_amount=250)
+    Billing.edit_visit(path, rollup, second, edited)
+    Billing.remove_visit(path, rollup, first)
+
+    restart()
+    assert load_json(path, {}) == Billing.rebuild([edited])
+
+
+def test_each_change_is_one_journal_entry(tmp_path):
+    path = str(tmp_path / Billing.ROLLUP_FILE)
+    save_json(path, {})
+    rollup = load_json(path, {})
+    old = visit("1", "2026-10-17")
+    Billing.add_visit(path, rollup, old)
+    Billing.edit_visit(path, rollup, old, visit("1", "2026-10-17", fee=150))
+    with open(journal_path(path)) as f:
+        assert len(f.read().splitlines()) == 3  # header + one line per change
+    assert os.path.exists(path)
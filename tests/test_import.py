@@ -0,0 +1,84 @@
+import json
+import os
+
+import pytest
+
+from Utils import Billing, Import, Partitions, Patients
+from Utils.Import import import_file
+from Utils.Storage import load_json
+
+from conftest import restart, visit as make_visit
+
+
+def visit(record_id, date, total=100):
+    return make_visit(record_id, date, phone=f"98765432{record_id:0>2}", fee=total)
+
+
+@pytest.fixture
+def data_dir(data_dir):
+    Partitions.append_records(data_dir, [visit("1", "2026-09-30"), visit("2", "2026-10-01")])
+    Billing.rebuild_files(data_dir)
+    Patients.rebuild_files(data_dir)
+    return data_dir
+
+
+def write_source(tmp_path, records, truncate=False):
+    raw = json.dumps(records)
+    path = tmp_path / "source.json"
+    path.write_text(raw[:len(raw) // 2] if truncate else raw)
+    return str(path)
+
+
+def ids(data_dir):
+    restart()
+    return sorted(record["id"] for record in Partitions.load_all(data_dir))
+
+
+def test_truncated_replace_keeps_existing_visits(tmp_path, data_dir):
+    source = write_source(tmp_path, [visit(str(i), "2026-08-01") for i in range(10, 20)], truncate=True)
+    with pytest.raises(ValueError):
+        import_file(source, data_dir, replace=True)
+
+    assert ids(data_dir) == ["1", "2"]
+    assert load_json(os.path.join(data_dir, "earnings.json"), {}) == {"2026-09-30": 100, "2026-10-01": 100}
+    assert [name for name in os.listdir(data_dir) if name.startswith("import.")] == []
+
+
+def test_replace_swaps_in_the_source(tmp_path, data_dir):
+    source = write_source(tmp_path, [visit("10", "2026-08-01", 300), visit("11", "2026-10-05")])
+    report = import_file(source, data_dir, replace=True)
+
+    assert report["imported"] == 2
+    assert ids(data_dir) == ["10", "11"]
+    assert load_json(os.path.join(data_dir, "earnings.json"), {}) == {"2026-08-01": 300, "2026-10-05": 100}
+    assert sorted(load_json(os.path.join(data_dir, Patients.INDEX_FILE), {})) == ["p:9876543210", "p:9876543211"]
+
+
+def test_colliding_ids_are_replaced(tmp_path, data_dir):
+    source = write_source(tmp_path, [visit("2", "2026-10-02"), visit("3", "2026-10-03"), visit("3", "2026-10-04"),
+                                     {"date": "not a date"}])
+    report = import_file(source, data_dir)
+
+    assert report["imported"] == 3 and len(report["rejected"]) == 1
+    found = ids(data_dir)
+    assert len(found) == 5 and len(set(found)) == 5 and {"1", "2", "3"} <= set(found)
+    assert sum(load_json(os.path.join(data_dir, "earnings.json"), {}).values()) == 500
+
+
+def test_failed_add_creates_no_new_months(tmp_path, data_dir):
+    months = Partitions.months(data_dir)
+    source = write_source(tmp_path, [visit(str(i), f"2026-0{i}-01") for i in range(1, 8)], truncate=True)
+    with pytest.raises(ValueError):
+        import_file(source, data_dir, batch_size=1)
+
+    assert Partitions.months(data_dir) == months
+
+
+@pytest.mark.parametrize("layout", ["array", "lines"])
+def test_records_split_across_chunks(tmp_path, monkeypatch, layout):
+    monkeypatch.setattr(Import, "CHUNK_SIZE", 7)
+    records = [visit(str(i), "2026-10-01") for i in range(1, 20)]
+    path = tmp_path / "source.json"
+    path.write_text(json.dumps(records, indent=1) if layout == "array" else "\n".join(map(json.dumps, records)) + "\n")
+
+    assert list(Import.iter_json(str(path))) == records
@@ -0,0 +1,134 @@
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from Utils import Billing, Ingest, Partitions, Patients
+from Utils.Storage import load_json, save_json
+
+from conftest import restart, visit as make_visit
+
+
+def visit(record_id, date, phone):
+    return make_visit(record_id, date, phone=phone, tests=[("CBC", 300)])
+
+
+@pytest.fixture
+def data_dir(data_dir):
+    Partitions.append_records(data_dir, [visit("a", "2026-09-30", "9876543210"), visit("b", "2026-10-01", "9876543211")])
+    Billing.rebuild_files(data_dir)
+    Patients.rebuild_files(data_dir)
+    return data_dir
+
+
+def snapshot(data_dir):
+    restart()
+    return ([record.to_json() for record in Partitions.load_all(data_dir)],
+            load_json(os.path.join(data_dir, Billing.ROLLUP_FILE), {}),
+            load_json(os.path.join(data_dir, "earnings.json"), {}))
+
+
+def test_batch_updates_visits_earnings_and_index(data_dir):
+    report = Ingest.apply_batch(data_dir, [
+        {"op": "result", "phone": "9876543210", "test": "CBC", "value": "12"},
+        {"op": "add_test", "id": "b", "test": "SGPT"},
+        {"op": "visit", "record": visit("", "2026-10-02", "9876543212")},
+        {"op": "price", "test": "LFT", "cost": 500},
+    ])
+    assert report["committed"] and not report["errors"]
+    assert (report["visits_updated"], report["visits_added"], report["prices_set"]) == (2, 1, 1)
+
+    records, rollup, earnings = snapshot(data_dir)
+    assert rollup == Billing.rebuild(records)
+    assert earnings == {"2026-09-30": 400, "2026-10-01": 600, "2026-10-02": 400}
+    assert "p:9876543212" in load_json(os.path.join(data_dir, Patients.INDEX_FILE), {})
+    assert load_json(os.path.join(data_dir, "tests.json"), {})["LFT"] == 500
+
+
+def test_bad_item_writes_nothing(data_dir):
+    before = snapshot(data_dir)
+    report = Ingest.apply_batch(data_dir, [{"op": "result", "id": "a", "test": "CBC", "value": "1"},
+                                           {"op": "result", "id": "b", "test": "NOPE", "value": "1"}])
+    assert not report["committed"] and report["errors"][0]["item"] == 2
+    assert snapshot(data_dir) == before
+
+
+def test_visit_deleted_after_planning_fails_the_whole_batch(data_dir, monkeypatch):
+    before = snapshot(data_dir)
+    plan = Ingest.plan
+
+    def plan_then_delete(*args):
+        planned = plan(*args)
+        Partitions.delete_record(data_dir, visit("b", "2026-10-01", ""))  # at another terminal
+        return planned
+
+    monkeypatch.setattr(Ingest, "plan", plan_then_delete)
+    report = Ingest.apply_batch(data_dir, [{"op": "add_test", "id": "a", "test": "SGPT"},
+                                           {"op": "add_test", "id": "b", "test": "SGPT"}])
+    assert not report["committed"]
+    records, rollup, earnings = snapshot(data_dir)
+    assert records == before[0][:1] and earnings == before[2]
+
+
+def test_serving_beyond_this_machine_needs_a_token(data_dir):
+    with pytest.raises(SystemExit):
+        Ingest.serve(data_dir, host="0.0.0.0", port=0)
+
+
+@pytest.fixture
+def server(data_dir):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Ingest.make_handler(data_dir))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/batch"
+    server.shutdown()
+    server.server_close()
+
+
+def post(url, body, headers={}):
+    # (status, reply) for a POST
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=body, method="POST", headers=headers)) as reply:
+            return reply.status, json.load(reply)
+    except urllib.error.HTTPError as exc:
+        return exc.code, json.load(exc)
+
+
+BODY = json.dumps([{"op": "result", "id": "a", "test": "CBC", "value": "7"}]).encode()
+
+
+def test_token_is_checked(data_dir, server):
+    save_json(os.path.join(data_dir, "admin_config.json"), {"api_token": "secret"})
+    assert post(server, BODY)[0] == 401
+    assert post(server, BODY, {"X-Api-Token": "wrong"})[0] == 401
+    status, report = post(server, BODY, {"X-Api-Token": "secret"})
+    assert status == 200 and report["committed"]
+
+
+def test_bad_or_oversized_body_is_refused(server, monkeypatch):
+    monkeypatch.setattr(Ingest, "MAX_BODY", 10)
+    assert post(server, BODY)[0] == 413
+    assert post(server, b"[]", {"Content-Length": "lots"})[0] == 400
+
+
+def test_failed_batch_gets_a_json_error(server, monkeypatch):
+    def fail(data_dir, items, partial=False):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(Ingest, "apply_batch", fail)
+    status, reply = post(server, BODY)
+    assert status == 500 and "disk full" in reply["error"] and not reply["committed"]
+
+
+def test_id_is_found_in_the_month_the_index_lists(data_dir, monkeypatch):
+    restart()
+    loaded = []
+    load_partition = Partitions.load_partition
+    monkeypatch.setattr(Partitions, "load_partition", lambda filepath: loaded.append(filepath) or load_partition(filepath))
+    filepath, record = Ingest._Matcher(data_dir).find({"op": "result", "id": "b", "test": "CBC"})
+
+    assert record["id"] == "b"
+    assert loaded == [Partitions.file_for(data_dir, "2026-10-01")] == [filepath]
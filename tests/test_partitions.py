@@ -0,0 +1,48 @@
+import json
+import os
+
+from Utils import Partitions
+from Utils.Storage import load_json
+
+from conftest import restart, visit
+
+
+def test_migrate_splits_legacy_file_by_month(data_dir):
+    legacy = [visit("1", "2026-09-30"), visit("2", "2026-10-01"), visit("3", "2026-10-17"), visit("4", "")]
+    with open(os.path.join(data_dir, Partitions.LEGACY_FILE), "w") as f:
+        json.dump(legacy, f)
+
+    assert Partitions.migrate(data_dir) == 3
+    assert Partitions.months(data_dir) == ["2026-09", "2026-10", Partitions.UNDATED]
+    assert not os.path.exists(os.path.join(data_dir, Partitions.LEGACY_FILE))
+    assert os.path.exists(os.path.join(data_dir, Partitions.LEGACY_FILE + Partitions.MIGRATED_SUFFIX))
+    assert Partitions.migrate(data_dir) == 0
+
+    restart()
+    october = load_json(Partitions.partition_file(data_dir, "2026-10"), [])
+    assert [record["id"] for record in october] == ["2", "3"]
+    assert sorted(record["id"] for record in Partitions.load_all(data_dir)) == ["1", "2", "3", "4"]
+
+
+def test_migrate_leaves_no_partitions_after_a_failed_run(data_dir, monkeypatch):
+    with open(os.path.join(data_dir, Partitions.LEGACY_FILE), "w") as f:
+        json.dump([visit("1", "2026-09-30"), visit("2", "2026-10-01")], f)
+
+    calls = []
+
+    def crash_on_second(path, data):
+        calls.append(path)
+        if len(calls) == 2:
+            raise OSError("crash")
+        real_save(path, data)
+
+    real_save = Partitions.save_json
+    monkeypatch.setattr(Partitions, "save_json", crash_on_second)
+    try:
+        Partitions.migrate(data_dir)
+    except OSError:
+        pass
+    monkeypatch.undo()
+
+    assert not os.path.isdir(Partitions.partition_dir(data_dir))
+    assert Partitions.migrate(data_dir) == 2
@@ -0,0 +1,70 @@
+import os
+
+from Utils import Partitions, Patients
+from Utils.Storage import load_json
+
+from conftest import restart, visit
+
+
+def test_added_keeps_visits_in_date_order():
+    later = dict(visit("2", "2026-10-05", phone="9876543210"), age=31)
+    entry = Patients._added(None, later)
+    entry = Patients._added(entry, visit("1", "2026-09-01", phone="9876543210"))
+
+    assert entry["visits"] == [["2026-09-01", "1"], ["2026-10-05", "2"]]
+    # Demographics stay those of the latest visit
+    assert entry["age"] == 31
+
+
+def test_removed_drops_the_entry_with_its_last_visit():
+    first, second = visit("1", "2026-09-01", phone="9876543210"), visit("2", "2026-10-05", phone="9876543210")
+    entry = Patients._added(Patients._added(None, first), second)
+
+    entry = Patients._removed(entry, first)
+    assert entry["visits"] == [["2026-10-05", "2"]]
+    assert Patients._removed(entry, second) is None
+    assert Patients._removed(None, second) is None
+
+
+def test_edit_moves_the_visit_to_the_new_phone(data_dir):
+    index_file = os.path.join(data_dir, Patients.INDEX_FILE)
+    index = load_json(index_file, {})
+    old = visit("1", "2026-10-01", phone="9876543210")
+    Patients.add_visit(index_file, index, old)
+    Patients.edit_visit(index_file, index, old, dict(old, phone="9123456789"))
+
+    restart()
+    index = load_json(index_file, {})
+    assert list(index) == ["p:9123456789"]
+    assert index["p:9123456789"]["visits"] == [["2026-10-01", "1"]]
+
+
+def test_suggest_matches_name_or_phone_latest_first(data_dir):
+    index_file = os.path.join(data_dir, Patients.INDEX_FILE)
+    index = load_json(index_file, {})
+    Patients.add_visit(index_file, index, dict(visit("1", "2026-09-01", phone="9876543210"), name="Ram Kumar"))
+    Patients.add_visit(index_file, index, dict(visit("2", "2026-10-01", phone="9123456789"), name="Ramesh"))
+    Patients.add_visit(index_file, index, dict(visit("3", "2026-10-02", phone="9000000000"), name="Sita"))
+
+    assert Patients.suggest(index_file, index, "  RAM ") == ["p:9123456789", "p:9876543210"]
+    assert Patients.suggest(index_file, index, "98765") == ["p:9876543210"]
+    assert Patients.suggest(index_file, index, "ram", limit=1) == ["p:9123456789"]
+    assert Patients.suggest(index_file, index, "") == []
+
+    # A visit added after the search rows were built is found too
+    Patients.add_visit(index_file, index, dict(visit("4", "2026-10-03", phone="9111111111"), name="Ramu"))
+    assert Patients.suggest(index_file, index, "ram")[0] == "p:9111111111"
+
+
+def test_history_reads_only_the_months_visited(data_dir, monkeypatch):
+    Partitions.append_records(data_dir, [visit("1", "2026-08-01", phone="9876543210"),
+                                         visit("2", "2026-09-01", phone="9123456789"),
+                                         visit("3", "2026-10-01", phone="9876543210")])
+    entry = Patients.lookup(Patients.load_index(data_dir), phone="+91 98765 43210")
+
+    restart()
+    loaded = []
+    load_partition = Partitions.load_partition
+    monkeypatch.setattr(Partitions, "load_partition", lambda filepath: loaded.append(filepath) or load_partition(filepath))
+    assert [record["id"] for record in Patients.history(data_dir, entry)] == ["3", "1"]
+    assert sorted(loaded) == [Partitions.file_for(data_dir, "2026-08-01"), Partitions.file_for(data_dir, "2026-10-01")]
@@ -0,0 +1,16 @@
+import os
+
+from Utils import Partitions, Scheduler, Storage
+
+from conftest import restart, visit
+
+
+def test_backup_leaves_history_out_of_the_cache(data_dir, tmp_path):
+    backup_dir = str(tmp_path / "backup")
+    os.makedirs(backup_dir)
+    Partitions.append_records(data_dir, [visit(str(i), f"2026-{i:02d}-01") for i in range(1, 10)])
+    restart()
+
+    assert Scheduler._run(data_dir, backup_dir, "manual", True, False)
+    assert Scheduler.status()["last_file"] in os.listdir(backup_dir)
+    assert not [path for path in Partitions.partition_files(data_dir) if Storage.is_loaded(path)]
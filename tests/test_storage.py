@@ -0,0 +1,201 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from Utils import Storage
+from Utils.Storage import journal_path, load_json, save_json
+
+from conftest import restart, visit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def other_process(code):
+    # Runs code with Storage imported as S, in a separate interpreter
+    subprocess.run([sys.executable, "-c", f"import sys; sys.path.insert(0, {ROOT!r})\nfrom Utils import Storage as S\n{code}"],
+                   check=True)
+
+
+def add(amount):
+    return lambda value: (value or 0) + amount
+
+
+def test_journal_replayed_on_load(tmp_path):
+    path = str(tmp_path / "data.json")
+    save_json(path, [])
+    data = load_json(path, [])
+    Storage.append_record(path, data, {"name": "a"})
+    Storage.append_record(path, data, {"name": "b"})
+    assert os.path.exists(journal_path(path))
+
+    restart()
+    assert [r["name"] for r in load_json(path, [])] == ["a", "b"]
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    path = str(tmp_path / "data.json")
+    save_json(path, [])
+    data = load_json(path, [])
+    Storage.append_record(path, data, {"name": "a"})
+    with open(journal_path(path), "ab") as f:
+        f.write(b'{"op": "add", "record": {"na')  # crash part way through a line
+    size = os.path.getsize(journal_path(path))
+
+    restart()
+    data = load_json(path, [])
+    assert [r["name"] for r in data] == ["a"]
+    assert os.path.getsize(journal_path(path)) < size
+
+    # Later appends follow a clean line again
+    Storage.append_record(path, data, {"name": "b"})
+    restart()
+    assert [r["name"] for r in load_json(path, [])] == ["a", "b"]
+
+
+def test_journal_for_another_snapshot_is_ignored(tmp_path):
+    path = str(tmp_path / "data.json")
+    save_json(path, [{"id": "1", "name": "a"}])
+    with open(journal_path(path), "w") as f:
+        f.write(json.dumps({"op": "base", "digest": "not-this-snapshot"}) + "\n")
+        f.write(json.dumps({"op": "add", "record": {"id": "2", "name": "b"}}) + "\n")
+
+    assert [r["name"] for r in load_json(path, [])] == ["a"]
+    assert not os.path.exists(journal_path(path))
+
+
+def test_compaction_folds_journal_into_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(Storage, "COMPACT_EVERY", 3)
+    path = str(tmp_path / "data.json")
+    save_json(path, {})
+    data = load_json(path, {})
+    for i in range(4):
+        Storage.set_value(path, data, f"k{i}", i)
+
+    with open(path) as f:
+        assert json.load(f) == {"k0": 0, "k1": 1, "k2": 2}
+    with open(journal_path(path)) as f:
+        assert len(f.read().splitlines()) == 2  # header + k3
+
+    restart()
+    assert load_json(path, {}) == {"k0": 0, "k1": 1, "k2": 2, "k3": 3}
+
+
+def test_failed_append_leaves_memory_unchanged(tmp_path, monkeypatch):
+    path = str(tmp_path / "data.json")
+    save_json(path, {})
+    data = load_json(path, {})
+    Storage.set_value(path, data, "a", 1)
+
+    class DiskFull:
+        # Takes half of a journal line, then fails
+        def __init__(self, path, mode):
+            self.f = open(path, mode)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.f.close()
+
+        def write(self, raw):
+            self.f.write(raw[:len(raw) // 2])
+            raise OSError("No space left on device")
+
+    monkeypatch.setattr(Storage, "open", lambda path, mode="r": DiskFull(path, mode) if mode == "ab" else open(path, mode),
+                        raising=False)
+    with pytest.raises(OSError):
+        Storage.set_value(path, data, "b", 2)
+    assert data == {"a": 1}
+    monkeypatch.undo()
+
+    Storage.set_value(path, data, "c", 3)
+    restart()
+    assert load_json(path, {}) == {"a": 1, "c": 3}
+
+
+def test_ensure_ids_gives_old_records_ids(tmp_path):
+    path = str(tmp_path / "data.json")
+    with open(path, "w") as f:
+        json.dump([{"name": "a"}, {"id": "keep", "name": "b"}], f)
+
+    data = load_json(path, [])
+    assert Storage.ensure_ids(path, data)
+    assert data[1]["id"] == "keep" and data[0]["id"]
+    assert not Storage.ensure_ids(path, data)
+
+    restart()
+    assert [r["id"] for r in load_json(path, [])] == [data[0]["id"], "keep"]
+
+
+def test_two_writers_with_reload_in_between(tmp_path):
+    path = str(tmp_path / "rollup.json")
+    save_json(path, {})
+    first_session = load_json(path, {})
+    Storage.update_value(path, first_session, "total", add(100))
+
+    other_process(f"d = S.load_json({path!r}, {{}})\nS.update_value({path!r}, d, 'total', lambda v: (v or 0) + 50)")
+    second_session = load_json(path, {})
+    assert second_session is not first_session and second_session["total"] == 150
+
+    Storage.update_value(path, first_session, "total", add(10))
+    Storage.update_value(path, second_session, "total", add(1))
+    restart()
+    assert load_json(path, {}) == {"total": 161}
+
+
+def test_stale_copy_does_not_overwrite_other_process_appends(tmp_path):
+    path = str(tmp_path / "data.json")
+    save_json(path, [])
+    first_session = load_json(path, [])
+    Storage.append_record(path, first_session, {"name": "a"})
+
+    other_process(f"d = S.load_json({path!r}, [])\nS.append_record({path!r}, d, {{'name': 'b'}})")
+    load_json(path, [])  # another session reloads
+    Storage.append_record(path, first_session, {"name": "c"})
+    Storage.compact(path, load_json(path, []))
+
+    restart()
+    assert [r["name"] for r in load_json(path, [])] == ["a", "b", "c"]
+
+
+def test_evicted_file_is_released(tmp_path, monkeypatch):
+    first, second = str(tmp_path / "first.json"), str(tmp_path / "second.json")
+    save_json(first, [{"id": "1"}])
+    save_json(second, [{"id": str(i)} for i in range(50)])
+    monkeypatch.setattr(Storage, "CACHE_MAX_BYTES", os.path.getsize(second) + 10)
+
+    restart()
+    data = load_json(first, [])
+    assert Storage.get_record(first, data, "1") is not None
+    load_json(second, [])
+
+    assert all(cached[0] is not data for cached in Storage._id_indexes.values())
+    assert Storage._journals[first]["data"] is None
+    # A write through the evicted copy still lands on top of what is on disk
+    Storage.append_record(first, data, {"id": "2"})
+    restart()
+    assert [r["id"] for r in load_json(first, [])] == ["1", "2"]
+
+
+def test_sqlite_copy_follows_other_sessions(tmp_path, monkeypatch):
+    monkeypatch.setattr(Storage, "BACKEND", "sqlite")
+    path = str(tmp_path / "patients.json")
+    save_json(path, [visit(str(i), "2026-10-17") for i in range(1, 4)])
+    patients = load_json(path)
+
+    other_process(f"S.BACKEND = 'sqlite'\nS.delete_record({path!r}, S.load_json({path!r}), '1')")
+    found = Storage.find_patients(path, patients, datetime.date(2026, 10, 1), datetime.date(2026, 10, 31))
+    assert [record["id"] for _, record in found] == ["2", "3"]
+    assert all(patients[idx] is record for idx, record in found)
+
+    Storage.append_record(path, patients, visit("4", "2026-10-17"))
+    assert [record["id"] for record in Storage.read_json(path)] == ["2", "3", "4"]
+
+    other_process(f"S.BACKEND = 'sqlite'\nS.delete_record({path!r}, S.load_json({path!r}), '2')")
+    with pytest.raises(Storage.StaleWriteError):
+        save_json(path, patients)
+    assert [record["id"] for record in Storage.read_json(path)] == ["3", "4"]